@@ -1,21 +1,40 @@
 import asyncio
 import logging
-import json
 import os
 
 from aiogram import Bot, Dispatcher
 from aiogram.types import BotCommandScopeAllPrivateChats
 from aiogram.client.default import DefaultBotProperties
 from aiogram.enums import ParseMode
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler
+from aiohttp import web
 
 from dotenv import find_dotenv, load_dotenv
 
-from core.middlewares import DataBaseSession
+from core.config import ConfigStore
+from core.logger import setup_logging
+from core.metrics import (
+    instrument_sessions,
+    instrument_user_cache,
+    metrics_handler,
+    start_metrics_server,
+)
+from core.middlewares import (
+    ApiMetrics,
+    CallbackDedupe,
+    DataBaseSession,
+    HandlerMetrics,
+    TracingMiddleware,
+)
+from core.storage import build_storage
+from core.user_cache import usernames, users
 from core.database.engine import create_db, drop_db, session_maker
 from core.handlers.user_private import user_router
 from core.handlers.admin_private import admin_router
 from core.common.admin_cmds_list import set_admin_commands
 from core.common.user_cmds_list import private as user_cmds
+from services.broadcast import resume_broadcasts
+from services.scheduler import setup_scheduler, shutdown_scheduler
 
 
 load_dotenv(find_dotenv())
@@ -24,28 +43,11 @@ load_dotenv(find_dotenv())
 os.makedirs("images", exist_ok=True)
 os.makedirs("logs", exist_ok=True)
 
-# Create config.json if it doesn't exist
-if not os.path.exists("config.json"):
-    with open("config.json", "w") as f:
-        json.dump(
-            {
-                "buy_cards_link": "https://www.google.com/",
-                "full_card_link": "https://www.google.com/",
-                "notification_time": 0,
-                "notification_days": ["0"],
-                "cards_limit": 3,
-                "scheduler_status": False,
-                "help_text": "Empty. Заполните вручную",
-                "start_text": "Empty. Заполните вручную",
-            },
-            f,
-        )
-
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
-    handlers=[logging.FileHandler("logs/bot.log"), logging.StreamHandler()],
-)
+# Load config.json once, it is created with defaults if it doesn't exist
+config = ConfigStore("config.json")
+config.load()
+
+setup_logging("logs/bot.log")
 logger = logging.getLogger(__name__)
 
 bot = Bot(
@@ -54,8 +56,10 @@ bot = Bot(
 
 admin_list = os.getenv("ADMIN_LIST").replace(" ", "").split(",")
 bot.my_admins_list = admin_list
+bot.session.middleware(ApiMetrics())
 
-dp = Dispatcher()
+dp = Dispatcher(storage=build_storage(session_maker))
+dp["config"] = config
 dp.include_router(user_router)
 dp.include_router(admin_router)
 
@@ -63,30 +67,47 @@ dp.include_router(admin_router)
 async def on_startup(bot):
     # await drop_db()
     await create_db()
+    config.start()
+    await resume_broadcasts(bot)
+    await setup_scheduler(bot, config)
 
 
 async def on_shutdown(bot):
     logger.info("Bot down")
 
-    with open("config.json", "r") as f:
-        data = json.load(f)
+    # scheduler_status is kept, so daily cards are re-armed on the next start
+    shutdown_scheduler()
+    await config.close()
+    await usernames.flush()
+
+
+def setup_dispatcher():
+    dp.startup.register(on_startup)
+    dp.shutdown.register(on_shutdown)
+
+    dp.update.outer_middleware(TracingMiddleware())
+    db_session = DataBaseSession(session_pool=session_maker)
+    dp.update.middleware(db_session)
+    instrument_sessions(db_session)
+    instrument_user_cache(users)
+    dp.callback_query.outer_middleware(CallbackDedupe())
 
-    if data.get("scheduler_status", True):
-        data["scheduler_status"] = False
+    for router in (user_router, admin_router):
+        router.message.middleware(HandlerMetrics("message"))
+        router.callback_query.middleware(HandlerMetrics("callback_query"))
 
-        with open("config.json", "w") as f:
-            json.dump(data, f)
 
-        logger.info("Scheduler status set to False in config.json")
-    else:
-        logger.info("Scheduler was already set to False in config.json")
+# Port of the /metrics endpoint in polling mode, 0 turns it off. In webhook
+# mode /metrics is served next to the webhook.
+METRICS_HOST = os.getenv("METRICS_HOST", "0.0.0.0")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
 
 
 async def main():
-    dp.startup.register(on_startup)
-    dp.shutdown.register(on_shutdown)
+    setup_dispatcher()
 
-    dp.update.middleware(DataBaseSession(session_pool=session_maker))
+    if METRICS_PORT:
+        await start_metrics_server(METRICS_HOST, METRICS_PORT)
 
     await bot.delete_webhook(drop_pending_updates=True)
     await bot.set_my_commands(
@@ -95,8 +116,70 @@ async def main():
     await dp.start_polling(bot, allowed_updates=dp.resolve_used_update_types())
 
 
+# WEBHOOK MODE
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))
+# Seconds in-flight updates get to finish on shutdown
+WEBHOOK_DRAIN_TIMEOUT = float(os.getenv("WEBHOOK_DRAIN_TIMEOUT", "30"))
+
+
+async def on_webhook_startup(app: web.Application):
+    # Pending updates are kept, Telegram delivers them once we're back up.
+    # Every worker sets the same webhook, so the call is idempotent.
+    await bot.set_webhook(
+        url=WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+        secret_token=WEBHOOK_SECRET,
+        max_connections=WEBHOOK_MAX_CONNECTIONS,
+        allowed_updates=dp.resolve_used_update_types(),
+        drop_pending_updates=False,
+    )
+    await bot.set_my_commands(
+        commands=user_cmds, scope=BotCommandScopeAllPrivateChats()
+    )
+    await dp.emit_startup(bot=bot, **dp.workflow_data)
+
+
+async def on_webhook_cleanup(app: web.Application):
+    # Runs after aiohttp has drained in-flight requests, so handlers still
+    # have the bot session and the database while they finish
+    await dp.emit_shutdown(bot=bot, **dp.workflow_data)
+    await bot.session.close()
+
+
+def run_webhook():
+    setup_dispatcher()
+
+    if not WEBHOOK_SECRET:
+        logger.warning("WEBHOOK_SECRET is not set, webhook requests aren't verified.")
+
+    app = web.Application()
+    # Updates are handled inside the request, an update cut off by a restart
+    # is not acknowledged and Telegram sends it again
+    handler = SimpleRequestHandler(dispatcher=dp, bot=bot, secret_token=WEBHOOK_SECRET)
+    app.router.add_post(WEBHOOK_PATH, handler.handle)
+    app.router.add_get("/metrics", metrics_handler)
+    app.on_startup.append(on_webhook_startup)
+    app.on_cleanup.append(on_webhook_cleanup)
+
+    web.run_app(
+        app,
+        host=WEBHOOK_HOST,
+        port=WEBHOOK_PORT,
+        shutdown_timeout=WEBHOOK_DRAIN_TIMEOUT,
+        # Lets several workers listen on the same port behind a balancer
+        reuse_port=True,
+    )
+
+
 if __name__ == "__main__":
     try:
-        asyncio.run(main())
+        if os.getenv("BOT_MODE", "polling") == "webhook":
+            run_webhook()
+        else:
+            asyncio.run(main())
     except KeyboardInterrupt:
         logger.error("Bot stopped!")
@@ -0,0 +1,81 @@
+import asyncio
+from collections import Counter
+from datetime import datetime
+from typing import Any, AsyncGenerator
+
+from aiogram import Bot
+from aiogram.client.session.base import BaseSession
+from aiogram.methods import EditMessageText, SendMessage, SendPhoto, TelegramMethod
+from aiogram.types import Chat, Message, PhotoSize, User
+
+# Handlers catch their own exceptions and reply with this
+ERROR_TEXT = "Произошла ошибка"
+
+
+class FakeSession(BaseSession):
+    """Bot API stand-in, answers every call locally after ``latency`` seconds.
+
+    Sent messages come back as Message objects, photos with a file_id, every
+    other method returns True. Calls are counted by API method, error
+    replies of the handlers in ``errors``.
+    """
+
+    def __init__(self, latency: float = 0.0):
+        super().__init__()
+        self.latency = latency
+        self.calls = Counter()
+        self.errors = 0
+        self._message_id = 0
+
+    async def make_request(
+        self, bot: Bot, method: TelegramMethod, timeout: int | None = None
+    ) -> Any:
+        self.calls[method.__api_method__] += 1
+
+        if isinstance(method, (SendMessage, EditMessageText)) and ERROR_TEXT in (
+            method.text or ""
+        ):
+            self.errors += 1
+
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        if isinstance(method, SendPhoto):
+            # A path is "uploaded" once, later sends reuse the file_id
+            file_id = (
+                method.photo
+                if isinstance(method.photo, str)
+                else f"fake:{method.photo.path}"
+            )
+            photo = [
+                PhotoSize(file_id=file_id, file_unique_id=file_id, width=1, height=1)
+            ]
+            return self._message(bot, method.chat_id, photo=photo)
+
+        if isinstance(method, SendMessage):
+            return self._message(bot, method.chat_id, text=method.text)
+
+        return True
+
+    def _message(self, bot: Bot, chat_id: int, **fields) -> Message:
+        self._message_id += 1
+        return Message(
+            message_id=self._message_id,
+            date=datetime.now(),
+            chat=Chat(id=chat_id, type="private"),
+            from_user=User(id=bot.id, is_bot=True, first_name="bot"),
+            **fields,
+        )
+
+    async def stream_content(
+        self,
+        url: str,
+        headers=None,
+        timeout: int = 30,
+        chunk_size: int = 65536,
+        raise_for_status: bool = True,
+    ) -> AsyncGenerator[bytes, None]:
+        yield b""
+
+    async def close(self) -> None:
+        pass
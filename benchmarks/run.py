@@ -0,0 +1,321 @@
+"""Load test of the real dispatcher against a fake Bot API.
+
+    python -m benchmarks.run --users 50000 --deck 78 --requests 1000
+
+Synthetic updates go through ``dp.feed_update`` with every middleware of
+app.py, Telegram is replaced by FakeSession. The database is a fresh SQLite
+file in a temp dir unless --db-url points to a (disposable!) Postgres.
+Prints throughput, p50/p99 latency and failed updates per scenario, exits
+with 1 when any update failed.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+SCENARIOS = ("start", "card", "stats", "broadcast")
+STATS_LIST_MAX_USERS = 500
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=50000, help="users in the db")
+    parser.add_argument("--deck", type=int, default=78, help="cards in the deck")
+    parser.add_argument(
+        "--requests", type=int, default=1000, help="updates per scenario"
+    )
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument(
+        "--latency-ms", type=float, default=0.0, help="fake Bot API latency"
+    )
+    parser.add_argument("--db-url", help="defaults to SQLite in a temp dir")
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=SCENARIOS)
+    parser.add_argument("--json", action="store_true", help="print results as JSON")
+    return parser.parse_args()
+
+
+def prepare_env(args) -> str:
+    # app.py reads the environment and writes config.json, logs/ and images/
+    # into the working directory at import time
+    workdir = tempfile.mkdtemp(prefix="bot-bench-")
+    os.environ["DB_URL"] = args.db_url or f"sqlite+aiosqlite:///{workdir}/bench.db"
+    os.environ.setdefault("TOKEN", "123456:bench-token")
+    os.environ.setdefault("ADMIN_LIST", "1")
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+    # SQLite write locks under concurrency would log most writes as slow
+    os.environ.setdefault("DB_SLOW_QUERY_MS", "1000")
+    sys.path.insert(0, REPO_ROOT)
+    os.chdir(workdir)
+    return workdir
+
+
+def percentile(values: list[float], share: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * share))]
+
+
+def summary(name: str, latencies: list[float], elapsed: float, errors: int) -> dict:
+    return {
+        "scenario": name,
+        "count": len(latencies),
+        "errors": errors,
+        "error_rate": errors / len(latencies) if latencies else 0.0,
+        "throughput": len(latencies) / elapsed if elapsed else 0.0,
+        "p50_ms": percentile(latencies, 0.5) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+        "mean_ms": statistics.fmean(latencies) * 1000,
+    }
+
+
+class Bench:
+    def __init__(self, args):
+        self.args = args
+
+        import app
+        from benchmarks.fake_api import FakeSession
+        from core.middlewares import ApiMetrics
+
+        self.app = app
+        self.bot = app.bot
+        self.bot.session = FakeSession(latency=args.latency_ms / 1000)
+        self.bot.session.middleware(ApiMetrics())
+        self.update_id = 0
+
+    # Updates
+
+    def _user(self, tg_id: int):
+        from aiogram.types import User
+
+        return User(id=tg_id, is_bot=False, first_name="bench", username=f"u{tg_id}")
+
+    def message(self, tg_id: int, text: str):
+        from aiogram.types import Chat, Message, Update
+
+        self.update_id += 1
+        return Update(
+            update_id=self.update_id,
+            message=Message(
+                message_id=self.update_id,
+                date=datetime.now(),
+                chat=Chat(id=tg_id, type="private"),
+                from_user=self._user(tg_id),
+                text=text,
+            ),
+        )
+
+    def callback(self, tg_id: int, data: str):
+        from aiogram.types import CallbackQuery, Chat, Message, Update
+
+        self.update_id += 1
+        message = Message(
+            message_id=self.update_id,
+            date=datetime.now(),
+            chat=Chat(id=tg_id, type="private"),
+            from_user=self._user(self.bot.id),
+            text="Делаем расклад?",
+        )
+        return Update(
+            update_id=self.update_id,
+            callback_query=CallbackQuery(
+                id=str(self.update_id),
+                from_user=self._user(tg_id),
+                chat_instance="bench",
+                message=message,
+                data=data,
+            ),
+        )
+
+    # Setup
+
+    async def setup(self):
+        from core.database import orm_query as orm
+        from core.database.engine import session_maker
+        from core.database.models import Card, User
+
+        self.app.setup_dispatcher()
+        await self.app.create_db()
+
+        started = time.perf_counter()
+        async with session_maker() as session:
+            await orm.orm_bulk_insert(
+                session,
+                Card,
+                [
+                    {"description": f"Card {i}", "image": "images/bench.jpg"}
+                    for i in range(self.args.deck)
+                ],
+            )
+            await orm.orm_bulk_insert(
+                session,
+                User,
+                [
+                    {"tg_id": 1000 + i, "username": f"u{i}", "subscription": i % 2 == 0}
+                    for i in range(self.args.users)
+                ],
+            )
+
+        print(
+            f"Seeded {self.args.users} users and {self.args.deck} cards "
+            f"in {time.perf_counter() - started:.1f}s",
+            file=sys.stderr,
+        )
+
+    # Scenarios
+
+    async def feed(self, name: str, updates: list) -> dict:
+        semaphore = asyncio.Semaphore(self.args.concurrency)
+        latencies = []
+
+        async def one(update):
+            async with semaphore:
+                started = time.perf_counter()
+                await self.app.dp.feed_update(self.bot, update)
+                latencies.append(time.perf_counter() - started)
+
+        # A failed update still returns normally, with an error reply
+        errors_before = self.bot.session.errors
+        started = time.perf_counter()
+        await asyncio.gather(*(one(update) for update in updates))
+        return summary(
+            name,
+            latencies,
+            time.perf_counter() - started,
+            self.bot.session.errors - errors_before,
+        )
+
+    def known_ids(self, count: int) -> list[int]:
+        return [1000 + i % self.args.users for i in range(count)]
+
+    async def run_start(self) -> dict:
+        # Half known users, half new ones registering
+        count = self.args.requests
+        new_ids = range(1000 + self.args.users, 1000 + self.args.users + count // 2)
+        ids = self.known_ids(count - len(new_ids)) + list(new_ids)
+        return await self.feed("start", [self.message(i, "/start") for i in ids])
+
+    async def run_card(self) -> dict:
+        ids = self.known_ids(self.args.requests)
+        return await self.feed("card", [self.callback(i, "card") for i in ids])
+
+    async def run_stats(self) -> list[dict]:
+        admin = 1
+        ids = range(1, min(self.args.requests, self.args.users) + 1)
+        results = []
+
+        # The list screen puts every user in one keyboard, building it is
+        # quadratic in aiogram's builder and takes minutes past a few
+        # hundred users
+        if self.args.users <= STATS_LIST_MAX_USERS:
+            results.append(
+                await self.feed(
+                    "stats:list",
+                    [self.callback(admin, "statistics") for _ in range(10)],
+                )
+            )
+        else:
+            print(
+                f"stats:list skipped, more than {STATS_LIST_MAX_USERS} users",
+                file=sys.stderr,
+            )
+
+        results.append(
+            await self.feed(
+                "stats:user",
+                [self.callback(admin, f"statistics_{pk}") for pk in ids],
+            )
+        )
+        results.append(
+            await self.feed(
+                "stats:requests",
+                [self.callback(admin, f"requests_statistics_{pk}") for pk in ids],
+            )
+        )
+        return results
+
+    async def run_broadcast(self) -> dict:
+        from core.database.engine import session_maker
+        from core.database.models import Broadcast
+        from services.broadcast import Broadcaster, run_text_broadcast
+
+        async with session_maker() as session:
+            broadcast = Broadcast(text="Benchmark")
+            session.add(broadcast)
+            await session.commit()
+
+        # No rate limit, this measures our side of the pipeline
+        broadcaster = Broadcaster(concurrency=self.args.concurrency, rate=1e9)
+
+        started = time.perf_counter()
+        await run_text_broadcast(self.bot, broadcast.pk, broadcaster=broadcaster)
+        elapsed = time.perf_counter() - started
+
+        # The sender keeps its totals on the broadcast row
+        async with session_maker() as session:
+            broadcast = await session.get(Broadcast, broadcast.pk)
+
+        errors = broadcast.blocked + broadcast.failed
+        count = broadcast.sent + errors
+        return {
+            "scenario": "broadcast",
+            "count": count,
+            "errors": errors,
+            "error_rate": errors / count if count else 0.0,
+            "throughput": count / elapsed if elapsed else 0.0,
+            "elapsed_s": elapsed,
+        }
+
+    async def run(self) -> list[dict]:
+        from core.database.engine import engine
+
+        await self.setup()
+        results = []
+
+        try:
+            for name in self.args.scenarios:
+                result = await getattr(self, f"run_{name}")()
+                results.extend(result if isinstance(result, list) else [result])
+        finally:
+            await engine.dispose()
+
+        return results
+
+
+def print_table(results: list[dict]):
+    print(
+        f"{'scenario':<16}{'count':>8}{'errors':>8}{'req/s':>10}"
+        f"{'p50 ms':>10}{'p99 ms':>10}"
+    )
+    for row in results:
+        p50 = f"{row['p50_ms']:.1f}" if "p50_ms" in row else "-"
+        p99 = f"{row['p99_ms']:.1f}" if "p99_ms" in row else "-"
+        print(
+            f"{row['scenario']:<16}{row['count']:>8}{row['errors']:>8}"
+            f"{row['throughput']:>10.1f}"
+            f"{p50:>10}{p99:>10}"
+        )
+
+
+async def main():
+    args = parse_args()
+    prepare_env(args)
+    results = await Bench(args).run()
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print_table(results)
+
+    # Throughput with failed updates in it isn't a result
+    if any(row["errors"] for row in results):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
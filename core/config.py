@@ -0,0 +1,205 @@
+import asyncio
+import fcntl
+import json
+import logging
+import os
+import tempfile
+
+from dataclasses import asdict, dataclass, field, fields, replace
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class BotConfig:
+    buy_cards_link: str = "https://www.google.com/"
+    full_card_link: str = "https://www.google.com/"
+    notification_time: int = 0
+    notification_days: list[str] = field(default_factory=lambda: ["0"])
+    cards_limit: int = 3
+    scheduler_status: bool = False
+    help_text: str = "Empty. Заполните вручную"
+    start_text: str = "Empty. Заполните вручную"
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "BotConfig":
+        known = {f.name for f in fields(cls)}
+        return cls(**{key: value for key, value in data.items() if key in known})
+
+    def to_dict(self) -> dict:
+        return asdict(self)
+
+
+class ConfigStore:
+    """Process-wide holder of config.json.
+
+    The file is parsed once at startup and kept in memory. Handlers get the
+    store through the dispatcher context (``config`` argument), admin setters
+    go through :meth:`update`, and :meth:`watch` picks up edits made to the
+    file outside the bot by polling its mtime.
+
+    Writes are debounced: a burst of updates within ``flush_delay`` seconds is
+    flushed once, in a worker thread, through a temp file and ``os.replace`` so
+    readers never see a truncated file.
+
+    Several workers on one host may share the file (the compose mount): a
+    flush takes a lock on ``<path>.lock``, re-reads the file and writes only
+    the keys changed here over it, so edits to different keys on different
+    workers are all kept. Workers on separate hosts don't share the file and
+    each keep their own config, run a single worker there.
+    """
+
+    def __init__(
+        self,
+        path: str = "config.json",
+        reload_interval: float = 5.0,
+        flush_delay: float = 1.0,
+    ):
+        self.path = path
+        self.reload_interval = reload_interval
+        self.flush_delay = flush_delay
+        self._config = BotConfig()
+        # Bumped on every change, lets caches keyed on it go stale
+        self.version = 0
+        self._mtime = None
+        # Keys changed here and not written yet, they win over the file
+        self._pending: dict = {}
+        self._flush_lock = asyncio.Lock()
+        self._flush_failures = 0
+        self._flush_task = None
+        self._watch_task = None
+
+    @property
+    def current(self) -> BotConfig:
+        return self._config
+
+    def load(self) -> BotConfig:
+        if not os.path.exists(self.path):
+            self._apply(self._write({}))
+            return self._config
+
+        self._apply(self._read())
+        return self._config
+
+    def _read(self) -> dict:
+        with open(self.path, "r") as f:
+            data = json.load(f)
+            self._mtime = os.fstat(f.fileno()).st_mtime
+
+        return data
+
+    def _apply(self, data: dict) -> None:
+        config = BotConfig.from_dict({**data, **self._pending})
+
+        if config != self._config:
+            self._config = config
+            self.version += 1
+
+    def update(self, **changes) -> BotConfig:
+        self._config = replace(self._config, **changes)
+        self.version += 1
+        self._pending.update(changes)
+
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._delayed_flush())
+
+        return self._config
+
+    async def _delayed_flush(self, delay: float | None = None) -> None:
+        await asyncio.sleep(self.flush_delay if delay is None else delay)
+        await self.flush()
+
+    async def flush(self, retry: bool = True) -> None:
+        async with self._flush_lock:
+            if not self._pending:
+                return
+
+            changes, self._pending = self._pending, {}
+
+            try:
+                data = await asyncio.to_thread(self._write, changes)
+            except OSError:
+                self._pending = {**changes, **self._pending}
+                self._flush_failures += 1
+                logger.exception(f"Failed to write {self.path}")
+
+                # Nothing else writes the edits out, keep retrying with a
+                # backoff
+                if retry:
+                    delay = min(self.flush_delay * 2**self._flush_failures, 60.0)
+                    self._flush_task = asyncio.create_task(self._delayed_flush(delay))
+            else:
+                self._flush_failures = 0
+                # Picks up what other workers wrote meanwhile
+                self._apply(data)
+
+    def _write(self, changes: dict) -> dict:
+        # The file is replaced, not written in place, so the lock is a
+        # separate file every worker opens
+        with open(f"{self.path}.lock", "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+
+            try:
+                data = self._read()
+            except (FileNotFoundError, json.JSONDecodeError):
+                data = self._config.to_dict()
+
+            data = {**BotConfig.from_dict(data).to_dict(), **changes}
+            self._replace(data)
+            return data
+
+    def _replace(self, data: dict) -> None:
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+
+        try:
+            # mkstemp creates the file 0600, keep the mode of the file it
+            # replaces so other readers of the mount keep access
+            try:
+                mode = os.stat(self.path).st_mode & 0o777
+            except FileNotFoundError:
+                mode = 0o644
+
+            with os.fdopen(fd, "w") as f:
+                os.fchmod(f.fileno(), mode)
+                json.dump(data, f)
+                f.flush()
+                os.fsync(f.fileno())
+
+            os.replace(tmp_path, self.path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+        self._mtime = os.stat(self.path).st_mtime
+
+    def start(self) -> None:
+        self._watch_task = asyncio.create_task(self.watch())
+
+    async def close(self) -> None:
+        for task in (self._watch_task, self._flush_task):
+            if task is not None:
+                task.cancel()
+
+        await self.flush(retry=False)
+
+    async def watch(self) -> None:
+        while True:
+            await asyncio.sleep(self.reload_interval)
+
+            try:
+                mtime = (await asyncio.to_thread(os.stat, self.path)).st_mtime
+            except FileNotFoundError:
+                continue
+
+            if mtime == self._mtime:
+                continue
+
+            # Pending local edits are laid over the file until flushed
+            try:
+                self._apply(await asyncio.to_thread(self._read))
+                logger.info(f"Reloaded {self.path} after external change.")
+            except (OSError, json.JSONDecodeError, TypeError):
+                # Don't retry the same broken file every tick
+                self._mtime = mtime
+                logger.warning(f"{self.path} is not valid, keeping previous config.")
@@ -1,7 +1,11 @@
 import os
+from sqlalchemy import make_url, text
 from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
 
 from core.database.models import Base
+from core.database.migrations import run_migrations
+from core.metrics import InstrumentedQueuePool, instrument_engine
+from core.tracing import trace_engine
 
 #from .env file:
 # DB_LITE=sqlite+aiosqlite:///my_base.db
@@ -9,15 +13,46 @@ from core.database.models import Base
 
 # engine = create_async_engine(os.getenv('DB_LITE'), echo=True)
 
-engine = create_async_engine(os.getenv('DB_URL'), echo=False)
+def engine_options(url: str) -> dict:
+    # SQLite keeps SQLAlchemy's default pool, the rest is tuned from .env
+    if make_url(url).get_backend_name() == 'sqlite':
+        return {}
+
+    options = {
+        'poolclass': InstrumentedQueuePool,
+        'pool_size': int(os.getenv('DB_POOL_SIZE', '10')),
+        'max_overflow': int(os.getenv('DB_MAX_OVERFLOW', '20')),
+        'pool_timeout': float(os.getenv('DB_POOL_TIMEOUT', '30')),
+        'pool_pre_ping': os.getenv('DB_POOL_PRE_PING', '1') == '1',
+        'pool_recycle': int(os.getenv('DB_POOL_RECYCLE', '1800')),
+    }
+
+    if make_url(url).get_driver_name() == 'asyncpg':
+        # 0 turns asyncpg's prepared statement cache off, needed behind pgbouncer
+        options['connect_args'] = {'statement_cache_size': int(os.getenv('DB_STATEMENT_CACHE_SIZE', '100'))}
+
+    return options
+
+
+engine = create_async_engine(os.getenv('DB_URL'), echo=False, **engine_options(os.getenv('DB_URL')))
+instrument_engine(engine)
+trace_engine(engine)
 
 session_maker = async_sessionmaker(bind=engine, class_=AsyncSession, expire_on_commit=False)
 
+# Arbitrary key of the Postgres advisory lock taken while creating tables
+SCHEMA_LOCK_KEY = 4242
+
 
 async def create_db():
     async with engine.begin() as conn:
+        # Workers start together, they create and migrate tables one by one
+        if conn.dialect.name == 'postgresql':
+            await conn.execute(text('SELECT pg_advisory_xact_lock(:key)'), {'key': SCHEMA_LOCK_KEY})
+
         await conn.run_sync(Base.metadata.create_all)
- 
+        await conn.run_sync(run_migrations)
+
 
 async def drop_db():
     async with engine.begin() as conn:
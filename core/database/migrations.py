@@ -0,0 +1,122 @@
+import logging
+from datetime import datetime, timezone
+
+from sqlalchemy import func, insert, inspect, null, select, text, update
+from sqlalchemy.engine import Connection
+
+from core.database.models import Base, Card, CardDraw, DailyDraw, User
+from services.draw import day_start, local_day
+
+logger = logging.getLogger(__name__)
+
+
+def add_missing_columns(conn: Connection):
+    # create_all() doesn't touch existing tables, so new nullable columns
+    # are added here to keep old databases in sync with the models
+    inspector = inspect(conn)
+    quote = conn.dialect.identifier_preparer.quote
+
+    for table in Base.metadata.sorted_tables:
+        existing = {column["name"] for column in inspector.get_columns(table.name)}
+
+        for column in table.columns:
+            if column.name in existing:
+                continue
+
+            if not column.nullable:
+                logger.warning(
+                    f"Can't add NOT NULL column {table.name}.{column.name} automatically."
+                )
+                continue
+
+            column_type = column.type.compile(dialect=conn.dialect)
+            conn.execute(
+                text(
+                    f"ALTER TABLE {quote(table.name)} "
+                    f"ADD COLUMN {quote(column.name)} {column_type}"
+                )
+            )
+            logger.info(f"Added column {table.name}.{column.name}")
+
+
+def add_missing_indexes(conn: Connection):
+    # Same as above for indexes of existing tables
+    inspector = inspect(conn)
+
+    for table in Base.metadata.sorted_tables:
+        existing = {index["name"] for index in inspector.get_indexes(table.name)}
+
+        for index in table.indexes:
+            if index.name not in existing:
+                index.create(conn)
+                logger.info(f"Created index {index.name}")
+
+
+def backfill_card_draws(conn: Connection, chunk_size: int = 1000):
+    # Move the legacy User.cards JSON history into card_draw rows. Migrated
+    # users get cards = NULL, so this is a no-op once everything is moved.
+    users = conn.execute(
+        select(User.pk, User.cards).where(User.cards.isnot(None))
+    ).all()
+
+    if not users:
+        return
+
+    card_ids = set(conn.execute(select(Card.pk)).scalars())
+    rows = []
+
+    for user_pk, cards in users:
+        for card_pk, drawn_at in (cards or {}).items():
+            if int(card_pk) not in card_ids:
+                continue
+
+            drawn_at = datetime.fromisoformat(drawn_at)
+            if drawn_at.tzinfo is not None:
+                drawn_at = drawn_at.astimezone(timezone.utc).replace(tzinfo=None)
+
+            rows.append(
+                {"user_id": user_pk, "card_id": int(card_pk), "drawn_at": drawn_at}
+            )
+
+    for i in range(0, len(rows), chunk_size):
+        conn.execute(insert(CardDraw), rows[i : i + chunk_size])
+
+    user_pks = [user_pk for user_pk, _ in users]
+    for i in range(0, len(user_pks), chunk_size):
+        conn.execute(
+            update(User)
+            .where(User.pk.in_(user_pks[i : i + chunk_size]))
+            .values(cards=null())
+        )
+    logger.info(f"Moved {len(rows)} draws of {len(users)} users to card_draw")
+
+
+def backfill_daily_draws(conn: Connection):
+    # daily_draw starts empty, count today's draws so limits hold on the
+    # day it is introduced
+    if conn.execute(select(DailyDraw.user_id).limit(1)).first() is not None:
+        return
+
+    now = datetime.now(timezone.utc)
+    rows = conn.execute(
+        select(CardDraw.user_id, func.count())
+        .where(CardDraw.drawn_at >= day_start(now))
+        .group_by(CardDraw.user_id)
+    ).all()
+
+    if rows:
+        conn.execute(
+            insert(DailyDraw),
+            [
+                {"user_id": user_pk, "day": local_day(now), "draws": draws}
+                for user_pk, draws in rows
+            ],
+        )
+        logger.info(f"Counted today's draws of {len(rows)} users in daily_draw")
+
+
+def run_migrations(conn: Connection):
+    add_missing_columns(conn)
+    add_missing_indexes(conn)
+    backfill_card_draws(conn)
+    backfill_daily_draws(conn)
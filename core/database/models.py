@@ -1,6 +1,17 @@
-from sqlalchemy import DateTime, Float, String, Text, BigInteger, func, JSON
+from sqlalchemy import (
+    Date,
+    DateTime,
+    Float,
+    String,
+    Text,
+    BigInteger,
+    ForeignKey,
+    Index,
+    func,
+    JSON,
+)
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, relationship
-from datetime import datetime
+from datetime import date, datetime
 
 
 class Base(DeclarativeBase):
@@ -18,7 +29,8 @@ class User(Base):
     username: Mapped[str] = mapped_column(String(100), nullable=True)
     subscription: Mapped[bool] = mapped_column(default=False)
     last_request: Mapped[datetime] = mapped_column(DateTime, nullable=True)
-    cards: Mapped[dict] = mapped_column(JSON, default=dict, nullable=True)
+    # Legacy card_pk -> isoformat history, moved to card_draw on startup
+    cards: Mapped[dict] = mapped_column(JSON, nullable=True)
 
 
 class Card(Base):
@@ -27,3 +39,90 @@ class Card(Base):
     pk: Mapped[int] = mapped_column(primary_key=True)
     description: Mapped[str] = mapped_column(Text)
     image: Mapped[str] = mapped_column(String(100))
+    file_id: Mapped[str] = mapped_column(String(255), nullable=True)
+    # Filled by the upload pipeline, NULL for images stored before it
+    width: Mapped[int] = mapped_column(nullable=True)
+    height: Mapped[int] = mapped_column(nullable=True)
+    size_bytes: Mapped[int] = mapped_column(nullable=True)
+    content_hash: Mapped[str] = mapped_column(String(64), nullable=True, index=True)
+
+
+class ImageBlob(Base):
+    # A stored image file, shared by every card with the same content
+    __tablename__ = "image_blob"
+
+    pk: Mapped[str] = mapped_column(String(64), primary_key=True)
+    path: Mapped[str] = mapped_column(String(255))
+    # Cards using the file, it is removed by the GC once this reaches 0
+    refs: Mapped[int] = mapped_column(default=0)
+    size_bytes: Mapped[int] = mapped_column(nullable=True)
+    # Naive UTC, when refs last dropped, the GC waits a grace period after it
+    released_at: Mapped[datetime] = mapped_column(DateTime, nullable=True)
+
+
+class CardDraw(Base):
+    __tablename__ = "card_draw"
+    __table_args__ = (
+        Index("ix_card_draw_user_drawn_at", "user_id", "drawn_at"),
+        Index("ix_card_draw_user_card_drawn_at", "user_id", "card_id", "drawn_at"),
+    )
+
+    pk: Mapped[int] = mapped_column(primary_key=True)
+    user_id: Mapped[int] = mapped_column(ForeignKey("user.pk", ondelete="CASCADE"))
+    card_id: Mapped[int] = mapped_column(ForeignKey("card.pk", ondelete="CASCADE"))
+    # Naive UTC
+    drawn_at: Mapped[datetime] = mapped_column(DateTime)
+
+
+class DailyDraw(Base):
+    # Draws per user per Kyiv calendar day, checked against cards_limit
+    __tablename__ = "daily_draw"
+
+    user_id: Mapped[int] = mapped_column(
+        ForeignKey("user.pk", ondelete="CASCADE"), primary_key=True
+    )
+    day: Mapped[date] = mapped_column(Date, primary_key=True)
+    draws: Mapped[int] = mapped_column(default=0)
+
+
+class Broadcast(Base):
+    __tablename__ = "broadcast"
+
+    pk: Mapped[int] = mapped_column(primary_key=True)
+    text: Mapped[str] = mapped_column(Text)
+    status: Mapped[str] = mapped_column(String(20), default="running")
+    # Users are sent to in pk order, everyone up to this pk is done
+    last_user_pk: Mapped[int] = mapped_column(default=0)
+    sent: Mapped[int] = mapped_column(default=0)
+    blocked: Mapped[int] = mapped_column(default=0)
+    failed: Mapped[int] = mapped_column(default=0)
+    report_chat_id: Mapped[int] = mapped_column(BigInteger, nullable=True)
+
+
+class JobRun(Base):
+    __tablename__ = "job_run"
+
+    pk: Mapped[str] = mapped_column(String(50), primary_key=True)
+    # Naive UTC
+    last_run_at: Mapped[datetime] = mapped_column(DateTime, nullable=True)
+    # Checkpoint of the run in progress: the fire time it serves and the
+    # users (pk order) done so far
+    fire_time: Mapped[datetime] = mapped_column(DateTime, nullable=True)
+    last_user_pk: Mapped[int] = mapped_column(nullable=True)
+
+
+class JobLease(Base):
+    __tablename__ = "job_lease"
+
+    pk: Mapped[str] = mapped_column(String(100), primary_key=True)
+    owner: Mapped[str] = mapped_column(String(100))
+    # Naive UTC, the lease is free once this has passed
+    expires_at: Mapped[datetime] = mapped_column(DateTime)
+
+
+class FsmState(Base):
+    __tablename__ = "fsm_state"
+
+    pk: Mapped[str] = mapped_column(String(255), primary_key=True)
+    state: Mapped[str] = mapped_column(String(255), nullable=True)
+    data: Mapped[dict] = mapped_column(JSON, nullable=True)
@@ -1,6 +1,12 @@
-from sqlalchemy import select, update, delete
+from datetime import date, datetime
+from typing import AsyncIterator
+
+from sqlalchemy import select, update, delete, func, insert
+from sqlalchemy.dialects import postgresql, sqlite
 from sqlalchemy.ext.asyncio import AsyncSession
 
+from core.database.models import User, Card, CardDraw, DailyDraw, ImageBlob
+
 
 async def orm_create(session: AsyncSession, model: object, data: dict):
     obj = model(**data)
@@ -40,3 +46,211 @@ async def orm_update(session: AsyncSession, model: object, pk: int, data: dict):
 async def orm_delete(session: AsyncSession, model: object, pk: int):
     await session.execute(delete(model).where(model.pk == pk))
     return await session.commit()
+
+
+async def orm_bulk_insert(
+    session: AsyncSession, model: object, rows: list[dict], chunk_size: int = 1000
+):
+    for i in range(0, len(rows), chunk_size):
+        await session.execute(insert(model), rows[i : i + chunk_size])
+
+    await session.commit()
+
+
+async def orm_bulk_update(
+    session: AsyncSession, model: object, rows: list[dict], chunk_size: int = 1000
+):
+    # Every row must contain "pk", the other keys are the new values
+    for i in range(0, len(rows), chunk_size):
+        await session.execute(update(model), rows[i : i + chunk_size])
+
+    await session.commit()
+
+
+async def orm_read_batches(
+    session: AsyncSession,
+    model: object,
+    batch_size: int = 1000,
+    after_pk: int = 0,
+    **filters,
+) -> AsyncIterator[list]:
+    # Keyset pages for long jobs: no cursor or transaction stays open while
+    # the caller works on a batch
+    while True:
+        query = (
+            select(model)
+            .where(model.pk > after_pk)
+            .order_by(model.pk)
+            .limit(batch_size)
+        )
+        if filters:
+            query = query.filter_by(**filters)
+
+        result = await session.execute(query)
+        items = result.scalars().all()
+        await session.commit()
+
+        if not items:
+            return
+
+        yield items
+        after_pk = items[-1].pk
+
+
+async def orm_read_columns(
+    session: AsyncSession, model: object, columns: list[str], **filters
+):
+    query = select(*(getattr(model, column) for column in columns))
+    if filters:
+        query = query.filter_by(**filters)
+
+    result = await session.execute(query)
+    return result.all()
+
+
+async def orm_add_draw(
+    session: AsyncSession,
+    user_pk: int,
+    card_pk: int,
+    drawn_at: datetime,
+    last_request: datetime,
+):
+    session.add(CardDraw(user_id=user_pk, card_id=card_pk, drawn_at=drawn_at))
+    await session.execute(
+        update(User).where(User.pk == user_pk).values(last_request=last_request)
+    )
+    await session.commit()
+
+
+async def orm_count_draws(session: AsyncSession, user_pk: int, since: datetime) -> int:
+    result = await session.execute(
+        select(func.count())
+        .select_from(CardDraw)
+        .where(CardDraw.user_id == user_pk, CardDraw.drawn_at >= since)
+    )
+    return result.scalar_one()
+
+
+def _upsert(session: AsyncSession, model: object):
+    # INSERT ... ON CONFLICT, both supported databases spell it the same way
+    if session.bind.dialect.name == "postgresql":
+        return postgresql.insert(model)
+    return sqlite.insert(model)
+
+
+async def orm_take_daily_slot(
+    session: AsyncSession, user_pk: int, day: date, limit: int
+) -> int | None:
+    """Count one draw against the user's limit for ``day``.
+
+    A single atomic statement, so concurrent taps can't go over the limit.
+    Returns the draws made on ``day`` including this one, or None and counts
+    nothing once the limit is reached. Not committed, roll back to give the
+    slot back.
+    """
+    if limit <= 0:
+        return None
+
+    query = _upsert(session, DailyDraw).values(user_id=user_pk, day=day, draws=1)
+    query = query.on_conflict_do_update(
+        index_elements=[DailyDraw.user_id, DailyDraw.day],
+        set_={"draws": DailyDraw.draws + 1},
+        where=DailyDraw.draws < limit,
+    ).returning(DailyDraw.draws)
+
+    result = await session.execute(query)
+    return result.scalar()
+
+
+async def orm_add_daily_draws(session: AsyncSession, user_pks: list[int], day: date):
+    # Not limited and not committed, used by the daily cards job
+    if not user_pks:
+        return
+
+    query = _upsert(session, DailyDraw)
+    query = query.on_conflict_do_update(
+        index_elements=[DailyDraw.user_id, DailyDraw.day],
+        set_={"draws": DailyDraw.draws + 1},
+    )
+    await session.execute(
+        query, [{"user_id": pk, "day": day, "draws": 1} for pk in user_pks]
+    )
+
+
+async def orm_add_image_ref(
+    session: AsyncSession, content_hash: str, path: str, size_bytes: int | None
+):
+    # Not committed, goes in the same transaction as the card insert
+    query = _upsert(session, ImageBlob).values(
+        pk=content_hash, path=path, refs=1, size_bytes=size_bytes
+    )
+    query = query.on_conflict_do_update(
+        index_elements=[ImageBlob.pk],
+        set_={"refs": ImageBlob.refs + 1, "path": path},
+    )
+    await session.execute(query)
+
+
+async def orm_release_image_ref(
+    session: AsyncSession, content_hash: str, released_at: datetime
+):
+    # Not committed, goes in the same transaction as the card delete
+    await session.execute(
+        update(ImageBlob)
+        .where(ImageBlob.pk == content_hash)
+        .values(refs=ImageBlob.refs - 1, released_at=released_at)
+    )
+
+
+async def orm_get_or_create_user(
+    session: AsyncSession, tg_id: int, username: str | None
+):
+    """Register the user if needed, returns (pk, subscription, username).
+
+    INSERT ... ON CONFLICT DO NOTHING, so concurrent /starts of one user
+    can't hit the unique tg_id constraint. Existing users are left as they
+    are, the row is then read back.
+    """
+    columns = (User.pk, User.subscription, User.username)
+    query = (
+        _upsert(session, User)
+        .values(tg_id=tg_id, username=username)
+        .on_conflict_do_nothing(index_elements=[User.tg_id])
+    )
+
+    # SQLite before 3.35 has no RETURNING
+    if session.bind.dialect.insert_returning:
+        row = (await session.execute(query.returning(*columns))).first()
+    else:
+        await session.execute(query)
+        row = None
+
+    await session.commit()
+
+    if row is None:
+        result = await session.execute(select(*columns).where(User.tg_id == tg_id))
+        row = result.first()
+
+    return row
+
+
+async def orm_drawn_card_ids(
+    session: AsyncSession, user_pk: int, since: datetime
+) -> set[int]:
+    result = await session.execute(
+        select(CardDraw.card_id)
+        .where(CardDraw.user_id == user_pk, CardDraw.drawn_at >= since)
+        .distinct()
+    )
+    return set(result.scalars())
+
+
+async def orm_last_draws(session: AsyncSession, user_pk: int, limit: int = 10):
+    result = await session.execute(
+        select(CardDraw.drawn_at, Card)
+        .join(Card, Card.pk == CardDraw.card_id)
+        .where(CardDraw.user_id == user_pk)
+        .order_by(CardDraw.drawn_at.desc())
+        .limit(limit)
+    )
+    return result.all()
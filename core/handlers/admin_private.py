@@ -1,24 +1,24 @@
 import traceback
 import logging
-import uuid
-import json
-import os
 
-from datetime import datetime
+from datetime import datetime, timezone
 from aiogram import Router, F
 from aiogram.filters import Command
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.context import FSMContext
-from aiogram.types import Message, CallbackQuery, FSInputFile
+from aiogram.types import Message, CallbackQuery
 from sqlalchemy.ext.asyncio import AsyncSession
-from apscheduler.schedulers.asyncio import AsyncIOScheduler
 
-from core.database.models import User, Card
+from core.config import ConfigStore
+from core.database.models import User, Card, Broadcast
 from core.database import orm_query as orm
 from core.filters import IsAdmin
-from core.keyboards import get_callback_btns
-from core.utils import clean_html
-from services.scheduler import get_random_card
+from core.keyboards import BACK_TO_EDIT_CARDS, get_callback_btns, invalidate_markups
+from core.utils import clean_html, send_card_photo
+from services.broadcast import start_broadcast
+from services.draw import KYIV_TZ, deck
+from services.images import ingest_image
+from services.scheduler import arm_daily_cards, disarm_daily_cards
 
 
 logger = logging.getLogger(__name__)
@@ -49,8 +49,6 @@ DAYS = [
     "Воскресенье",
 ]
 
-scheduler = AsyncIOScheduler()
-
 
 @admin_router.message(Command("admin"))
 async def admin_features(message: Message, state: FSMContext):
@@ -81,15 +79,10 @@ async def callback_edit_cards(
     callback: CallbackQuery, session: AsyncSession, state: FSMContext
 ):
     try:
-        all_cards = await orm.orm_read(session=session, model=Card, as_iterable=True)
+        all_cards = await orm.orm_read_columns(session, Card, ["pk", "description"])
         btns = {}
         text = "Карточки"
 
-        if all_cards is False:
-            await callback.message.answer("Виникла помилка 😞...")
-            await admin_features(callback.message, state)
-            return
-
         if all_cards:
             for card in all_cards:
                 btns[
@@ -118,7 +111,7 @@ async def callback_edit_cards(
 
 async def edit_cards(message: Message, session: AsyncSession, text: str = None):
     try:
-        all_cards = await orm.orm_read(session=session, model=Card, as_iterable=True)
+        all_cards = await orm.orm_read_columns(session, Card, ["pk", "description"])
         btns = {}
 
         if not text:
@@ -149,7 +142,6 @@ async def callback_card(callback: CallbackQuery, session: AsyncSession):
     try:
         pk = int(callback.data.split("_")[1])
         card = await orm.orm_read(session=session, model=Card, pk=pk)
-        photo = FSInputFile(card.image, filename="card.jpg")
         btns = get_callback_btns(
             btns={
                 "Редактировать описание": f"edit_card_{card.pk}",
@@ -160,13 +152,24 @@ async def callback_card(callback: CallbackQuery, session: AsyncSession):
         )
 
         await callback.message.delete()
+        chat_id = callback.message.chat.id
         try:
-            await callback.message.answer_photo(
-                photo=photo, caption=card.description, reply_markup=btns
+            await send_card_photo(
+                callback.bot,
+                chat_id,
+                card,
+                session,
+                caption=card.description,
+                reply_markup=btns,
             )
         except Exception:
-            await callback.message.answer_photo(
-                photo=photo, caption="Невірний опис", reply_markup=btns
+            await send_card_photo(
+                callback.bot,
+                chat_id,
+                card,
+                session,
+                caption="Невірний опис",
+                reply_markup=btns,
             )
     except Exception:
         logger.error("Error in callback_card")
@@ -185,14 +188,14 @@ async def callback_edit_card(
 ):
     try:
         pk = int(callback.data.split("_")[2])
-        card = await orm.orm_read(session=session, model=Card, pk=pk)
 
         await callback.answer()
         await callback.message.answer(
             text="Введите новое описание",
-            reply_markup=get_callback_btns(btns={"Назад": "edit_cards"}),
+            reply_markup=BACK_TO_EDIT_CARDS,
         )
-        await state.set_data({"card": card})
+        # Only serialisable values go into FSM state
+        await state.set_data({"card_pk": pk})
         await state.set_state(EditDesc.description)
     except Exception:
         logger.error("Error in callback_edit_card")
@@ -206,11 +209,10 @@ async def edit_card_description(
     message: Message, state: FSMContext, session: AsyncSession
 ):
     try:
-        data = await state.get_data()
-        card = data["card"]
+        card_pk = await state.get_value("card_pk")
         clean_text = clean_html(message.text)
         await orm.orm_update(
-            session=session, model=Card, pk=card.pk, data={"description": clean_text}
+            session=session, model=Card, pk=card_pk, data={"description": clean_text}
         )
         await message.answer("Описание изменено")
         await edit_cards(message, session=session)
@@ -225,7 +227,16 @@ async def edit_card_description(
 async def callback_delete_card(callback: CallbackQuery, session: AsyncSession):
     try:
         pk = int(callback.data.split("_")[2])
+        card = await session.get(Card, pk)
+        # The file itself is removed by the image GC once unreferenced
+        if card is not None and card.content_hash:
+            await orm.orm_release_image_ref(
+                session,
+                card.content_hash,
+                datetime.now(timezone.utc).replace(tzinfo=None),
+            )
         await orm.orm_delete(session=session, model=Card, pk=pk)
+        deck.invalidate()
         result = await callback.message.delete()
 
         if result:
@@ -250,7 +261,7 @@ async def callback_add_card(callback: CallbackQuery, state: FSMContext):
     try:
         await callback.message.edit_text(
             text="Введите описание карточки",
-            reply_markup=get_callback_btns(btns={"Назад": "edit_cards"}),
+            reply_markup=BACK_TO_EDIT_CARDS,
         )
         await state.set_state(AddCard.description)
     except Exception:
@@ -266,7 +277,7 @@ async def add_card_description(message: Message, state: FSMContext):
         await state.update_data(description=message.text)
         await message.answer(
             "Отправьте карточку",
-            reply_markup=get_callback_btns(btns={"Назад": "edit_cards"}),
+            reply_markup=BACK_TO_EDIT_CARDS,
         )
         await state.set_state(AddCard.image)
     except Exception:
@@ -281,23 +292,35 @@ async def add_card_image(message: Message, state: FSMContext, session: AsyncSess
     try:
         desc = await state.get_value("description")
         clean_desc = clean_html(desc)
-        unique_filename = str(uuid.uuid4()) + ".jpg"
-        file_path = os.path.join("images", unique_filename)
 
-        await message.bot.download(
-            file=message.photo[-1].file_id, destination=file_path
-        )
+        raw = await message.bot.download(file=message.photo[-1].file_id)
+        file_path, image = await ingest_image(raw.getvalue())
 
         data = {
             "description": clean_desc,
             "image": file_path,
+            "width": image.width,
+            "height": image.height,
+            "size_bytes": image.size_bytes,
+            "content_hash": image.content_hash,
         }
 
+        # Same art as an existing card, Telegram already has the file
+        same_image = await orm.orm_read(
+            session, Card, as_iterable=True, content_hash=image.content_hash
+        )
+        if same_image and same_image[0].file_id:
+            data["file_id"] = same_image[0].file_id
+
+        await orm.orm_add_image_ref(
+            session, image.content_hash, file_path, image.size_bytes
+        )
         await orm.orm_create(
             session,
             Card,
             data,
         )
+        deck.invalidate()
 
         await state.clear()
         await edit_cards(message, session, text="Карточка добавлена")
@@ -358,7 +381,7 @@ async def callback_buy_cards_link(callback: CallbackQuery, state: FSMContext):
 
 @admin_router.message(ChangeLink.link_buy_cards)
 async def change_buy_cards_link(
-    message: Message, state: FSMContext, session: AsyncSession
+    message: Message, state: FSMContext, config: ConfigStore
 ):
     try:
         url = message.text
@@ -370,16 +393,9 @@ async def change_buy_cards_link(
             await state.set_state(ChangeLink.link_buy_cards)
             return
 
-        try:
-            with open("config.json", "r") as f:
-                data = json.load(f)
-        except json.JSONDecodeError:
-            data = {}
-
-        data["buy_cards_link"] = url
-
-        with open("config.json", "w") as f:
-            json.dump(data, f)
+        config.update(buy_cards_link=url)
+        # Menus built with the old link are never used again
+        invalidate_markups()
 
         await message.answer("Ссылка изменена")
         await admin_features(message, state)
@@ -404,7 +420,7 @@ async def callback_full_card_link(callback: CallbackQuery, state: FSMContext):
 
 @admin_router.message(ChangeLink.link_full_pack)
 async def change_full_card_link(
-    message: Message, state: FSMContext, session: AsyncSession
+    message: Message, state: FSMContext, config: ConfigStore
 ):
     try:
         url = message.text
@@ -416,16 +432,9 @@ async def change_full_card_link(
             await state.set_state(ChangeLink.link_full_pack)
             return
 
-        try:
-            with open("config.json", "r") as f:
-                data = json.load(f)
-        except json.JSONDecodeError:
-            data = {}
-
-        data["full_card_link"] = url
-
-        with open("config.json", "w") as f:
-            json.dump(data, f)
+        config.update(full_card_link=url)
+        # Menus built with the old link are never used again
+        invalidate_markups()
 
         await message.answer("Ссылка изменена")
         await admin_features(message, state)
@@ -460,12 +469,9 @@ async def callback_edit_notifications(callback: CallbackQuery, state: FSMContext
 
 # STATUS SCHEDULER
 @admin_router.callback_query(F.data == "status_scheduler")
-async def callback_status_scheduler(callback: CallbackQuery):
+async def callback_status_scheduler(callback: CallbackQuery, config: ConfigStore):
     try:
-        with open("config.json", "r") as f:
-            data = json.load(f)
-
-        status = data.get("scheduler_status", False)
+        status = config.current.scheduler_status
 
         if status:
             btns = {
@@ -495,54 +501,18 @@ async def callback_status_scheduler(callback: CallbackQuery):
 
 @admin_router.callback_query(F.data == "enable_scheduler")
 async def callback_enable_scheduler(
-    callback: CallbackQuery, state: FSMContext, session: AsyncSession
+    callback: CallbackQuery, state: FSMContext, config: ConfigStore
 ):
     try:
         logger.info("Enabling scheduler...")
 
-        if scheduler.running:
-            scheduler.remove_all_jobs()
-            scheduler.shutdown(wait=False)
-            logger.info("Scheduler stopped before enabling.")
-
-        # Load configuration from config.json
-        with open("config.json", "r") as f:
-            config = json.load(f)
-        logger.info("Configuration loaded successfully.")
-
-        # Get notification time and days from config
-        notification_time = config.get(
-            "notification_time", 20
-        )  # Default to 20 if not set
-        notification_days = config.get(
-            "notification_days", ["0"]
-        )  # Default to ["0", "1"] if not set
-        logger.info(
-            f"Notification time set to {notification_time}, days: {notification_days}"
-        )
-
-        # Schedule the job using the loaded configuration
-        scheduler.add_job(
-            get_random_card,
-            "cron",
-            hour=notification_time,
-            day_of_week=",".join(notification_days),
-            args=[callback.message, session],
-            timezone="Europe/Kiev",
-        )
-        scheduler.start()
-
-        with open("config.json", "r") as f:
-            data = json.load(f)
-
-        data["scheduler_status"] = True
-
-        with open("config.json", "w") as f:
-            json.dump(data, f)
+        # The job is re-armed from config on every startup
+        config.update(scheduler_status=True)
+        arm_daily_cards(config.current)
 
         logger.info("Scheduler started successfully.")
         await callback.answer("Планировщик включен.")
-        await callback_status_scheduler(callback)
+        await callback_status_scheduler(callback, config)
     except Exception:
         logger.error("Error in callback_enable_scheduler")
         logger.error(traceback.format_exc())
@@ -550,27 +520,17 @@ async def callback_enable_scheduler(
 
 
 @admin_router.callback_query(F.data == "disable_scheduler")
-async def callback_disable_scheduler(callback: CallbackQuery, state: FSMContext):
+async def callback_disable_scheduler(
+    callback: CallbackQuery, state: FSMContext, config: ConfigStore
+):
     try:
         logger.info("Disabling scheduler...")
 
-        if scheduler.running:
-            scheduler.remove_all_jobs()
-            scheduler.shutdown(wait=False)
-            logger.info("Scheduler disabled successfully.")
-        else:
-            logger.info("Scheduler was not running.")
-
-        with open("config.json", "r") as f:
-            data = json.load(f)
-
-        data["scheduler_status"] = False
-
-        with open("config.json", "w") as f:
-            json.dump(data, f)
+        config.update(scheduler_status=False)
+        disarm_daily_cards()
 
         await callback.answer("Планировщик выключен.")
-        await callback_status_scheduler(callback)
+        await callback_status_scheduler(callback, config)
     except Exception:
         logger.error("Error in callback_disable_scheduler")
         logger.error(traceback.format_exc())
@@ -579,7 +539,9 @@ async def callback_disable_scheduler(callback: CallbackQuery, state: FSMContext)
 
 # CHANGE TIME MENU
 @admin_router.callback_query(F.data == "change_time")
-async def callback_change_time(callback: CallbackQuery, state: FSMContext):
+async def callback_change_time(
+    callback: CallbackQuery, state: FSMContext, config: ConfigStore
+):
     try:
         await state.clear()
 
@@ -590,10 +552,7 @@ async def callback_change_time(callback: CallbackQuery, state: FSMContext):
         for hour in range(6, 23):  # Від 6:00 до 22:00 (22 включно)
             hour_btns[f"{hour:02d}:00"] = f"change_time_{hour}"
 
-        with open("config.json", "r") as f:
-            data = json.load(f)
-
-        hour = data.get("notification_time")
+        hour = config.current.notification_time
 
         if hour:
             await callback.message.edit_text(
@@ -622,17 +581,13 @@ async def callback_change_time(callback: CallbackQuery, state: FSMContext):
 
 # SELECT TIME
 @admin_router.callback_query(F.data.startswith("change_time_"))
-async def callback_change_time(callback: CallbackQuery, state: FSMContext):
+async def callback_change_time(
+    callback: CallbackQuery, state: FSMContext, config: ConfigStore
+):
     try:
         hour = int(callback.data.split("_")[2])
 
-        with open("config.json", "r") as f:
-            data = json.load(f)
-
-        data["notification_time"] = hour
-
-        with open("config.json", "w") as f:
-            json.dump(data, f)
+        config.update(notification_time=hour)
 
         await callback.answer(
             "Время изменено. Перезапустите планировщик для применения изменений."
@@ -647,7 +602,7 @@ async def callback_change_time(callback: CallbackQuery, state: FSMContext):
 # CHANGE DAYS MENU
 @admin_router.callback_query(F.data == "change_days")
 async def callback_change_days(
-    callback: CallbackQuery, state: FSMContext, loop: bool = False
+    callback: CallbackQuery, state: FSMContext, config: ConfigStore, loop: bool = False
 ):
     try:
         if loop:
@@ -656,12 +611,10 @@ async def callback_change_days(
             if data.get("notification_days") is None:
                 await state.clear()
 
-                with open("config.json", "r") as f:
-                    data = json.load(f)
+                data = config.current.to_dict()
         else:
             await state.clear()
-            with open("config.json", "r") as f:
-                data = json.load(f)
+            data = config.current.to_dict()
 
             await state.update_data(notification_days=data.get("notification_days"))
 
@@ -688,7 +641,9 @@ async def callback_change_days(
 
 # SELECT DAY
 @admin_router.callback_query(F.data.startswith("change_day_"))
-async def callback_change_day_status(callback: CallbackQuery, state: FSMContext):
+async def callback_change_day_status(
+    callback: CallbackQuery, state: FSMContext, config: ConfigStore
+):
     try:
         day = callback.data.split("_")[2]
         data = await state.get_data()
@@ -701,7 +656,7 @@ async def callback_change_day_status(callback: CallbackQuery, state: FSMContext)
 
         await state.update_data(notification_days=notification_days)
 
-        await callback_change_days(callback, state, loop=True)
+        await callback_change_days(callback, state, config, loop=True)
     except Exception:
         logger.error("Error in callback_change_day_status")
         logger.error(traceback.format_exc())
@@ -744,52 +699,44 @@ async def callback_send_reason(callback: CallbackQuery, state: FSMContext):
 
 @admin_router.message(SendNotification.reason)
 async def callback_send_reason(
-    message: Message, state: FSMContext, session: AsyncSession
+    message: Message, state: FSMContext, session: AsyncSession, config: ConfigStore
 ):
     data = await state.get_data()
     notification_days = data.get("notification_days")
     reason = message.text
     changed_days = ""
-    with open("config.json", "r") as f:
-        current_data = json.load(f)
-
-    users = await orm.orm_read(session=session, model=User, as_iterable=True)
 
     for i, day in enumerate(DAYS):
         if str(i) not in notification_days:
             changed_days += f"{day}, "
 
-    for user in users:
-        await message.bot.send_message(
-            user.tg_id,
-            f"<b><i>УВЕДОМЛЕНИЕ</i></b>\n\nДни когда не будут отправляться карты: {changed_days}\n\n<b>Повод:</b> {reason}",
-        )
+    broadcast = Broadcast(
+        text=f"<b><i>УВЕДОМЛЕНИЕ</i></b>\n\nДни когда не будут отправляться карты: {changed_days}\n\n<b>Повод:</b> {reason}",
+        report_chat_id=message.chat.id,
+    )
+    session.add(broadcast)
+    await session.commit()
+    start_broadcast(message.bot, broadcast.pk)
 
-    with open("config.json", "w") as f:
-        current_data["notification_days"] = notification_days
-        json.dump(current_data, f)
+    config.update(notification_days=notification_days)
 
     await message.answer(
-        "Дни изменены. Перезапустите планировщик для применения изменений."
+        "Дни изменены. Перезапустите планировщик для применения изменений.\n\n"
+        "Рассылка запущена, по завершении придет отчет."
     )
     await admin_features(message, state)
 
 
 @admin_router.callback_query(F.data == "send_notification")
 async def callback_send_notification(
-    callback: CallbackQuery, state: FSMContext, session: AsyncSession
+    callback: CallbackQuery, state: FSMContext, config: ConfigStore
 ):
     data = await state.get_data()
     notification_days = data.get("notification_days")
     changed_days_id = []
     changed_days = ""
 
-    with open("config.json", "r") as f:
-        current_data = json.load(f)
-
-    with open("config.json", "w") as f:
-        current_data["notification_days"] = notification_days
-        json.dump(current_data, f)
+    current_data = config.update(notification_days=notification_days).to_dict()
 
     for day in notification_days:
         if day in current_data.get("notification_days"):
@@ -814,13 +761,13 @@ async def callback_statistics(
     try:
         await state.clear()
 
-        users = await orm.orm_read(session=session, model=User, as_iterable=True)
+        users = await orm.orm_read_columns(session, User, ["pk", "username", "tg_id"])
         users_btns = {
             "Назад": "admin",
         }
 
         for user in users:
-            users_btns[user.username if user.username else user.telegram_id] = (
+            users_btns[user.username if user.username else str(user.tg_id)] = (
                 f"statistics_{user.pk}"
             )
 
@@ -874,25 +821,13 @@ async def callback_statistics_requests(
     try:
         user_pk = int(callback.data.split("_")[2])
         user = await orm.orm_read(session=session, model=User, pk=user_pk)
-        sorted_data = dict(
-            sorted(
-                user.cards.items(),
-                key=lambda item: datetime.fromisoformat(item[1]),
-                reverse=True,
-            )
-        )
-        sorted_data = dict(list(sorted_data.items())[:10])
+        last_draws = await orm.orm_last_draws(session, user_pk, limit=10)
         text = f"Последние запросы пользователя: {f'@{user.username}' if user.username else user.tg_id}\n\n"
 
-        for key, value in sorted_data.items():
-            dt = datetime.fromisoformat(value)
+        for drawn_at, card in last_draws:
+            dt = drawn_at.replace(tzinfo=timezone.utc).astimezone(KYIV_TZ)
             formatted_date = dt.strftime("%H:%M %d-%m-%Y")
-            card = await orm.orm_read(
-                session=session, model=Card, pk=int(key), as_iterable=False
-            )
-
-            if card:
-                text += f"{formatted_date}: {card.description[:40]}{'...' if card.description and len(card.description) > 40 else ''}\n"
+            text += f"{formatted_date}: {card.description[:40]}{'...' if card.description and len(card.description) > 40 else ''}\n"
 
         await callback.message.edit_text(
             text=text,
@@ -911,12 +846,11 @@ class ChangeLimits(StatesGroup):
 
 
 @admin_router.callback_query(F.data == "edit_limits")
-async def callback_edit_limits(callback: CallbackQuery, state: FSMContext):
+async def callback_edit_limits(
+    callback: CallbackQuery, state: FSMContext, config: ConfigStore
+):
     try:
-        with open("config.json", "r") as f:
-            data = json.load(f)
-
-        cards_limit = data.get("cards_limit")
+        cards_limit = config.current.cards_limit
 
         await callback.message.edit_text(
             text=f"Введите лимит карточек. Текущий лимит: {cards_limit if cards_limit else 3}",
@@ -930,7 +864,9 @@ async def callback_edit_limits(callback: CallbackQuery, state: FSMContext):
 
 
 @admin_router.message(ChangeLimits.limit)
-async def callback_change_limits(message: Message, state: FSMContext):
+async def callback_change_limits(
+    message: Message, state: FSMContext, config: ConfigStore
+):
     try:
         limit = message.text
 
@@ -946,13 +882,7 @@ async def callback_change_limits(message: Message, state: FSMContext):
             await state.set_state(ChangeLimits.limit)
             return
 
-        with open("config.json", "r") as f:
-            data = json.load(f)
-
-        data["cards_limit"] = limit
-
-        with open("config.json", "w") as f:
-            json.dump(data, f)
+        config.update(cards_limit=limit)
 
         await message.answer(text="Лимит изменен")
         await admin_features(message, state)
@@ -976,16 +906,12 @@ async def callback_edit_help(callback: CallbackQuery, state: FSMContext):
 
 
 @admin_router.message(ChangeHelp.help)
-async def callback_change_help(message: Message, state: FSMContext):
+async def callback_change_help(
+    message: Message, state: FSMContext, config: ConfigStore
+):
     clean_text = clean_html(message.text)
 
-    with open("config.json", "r") as f:
-        data = json.load(f)
-
-    data["help_text"] = clean_text
-
-    with open("config.json", "w") as f:
-        json.dump(data, f)
+    config.update(help_text=clean_text)
 
     await message.answer("Текст изменен")
     await state.clear()
@@ -1006,15 +932,12 @@ async def callback_edit_start(callback: CallbackQuery, state: FSMContext):
 
 
 @admin_router.message(ChangeStart.start)
-async def callback_change_start(message: Message, state: FSMContext):
+async def callback_change_start(
+    message: Message, state: FSMContext, config: ConfigStore
+):
     clean_text = clean_html(message.text)
-    with open("config.json", "r") as f:
-        data = json.load(f)
-
-    data["start_text"] = clean_text
 
-    with open("config.json", "w") as f:
-        json.dump(data, f)
+    config.update(start_text=clean_text)
 
     await message.answer("Текст изменен")
     await state.clear()
@@ -1,20 +1,27 @@
-import json
 import logging
 import traceback
-import random
 
 from aiogram import F, types, Router
-from zoneinfo import ZoneInfo
 from sqlalchemy.ext.asyncio import AsyncSession
 from datetime import datetime, timedelta, timezone
-from aiogram.types import FSInputFile
 from aiogram.fsm.context import FSMContext
 from aiogram.filters import CommandStart, Command, or_f
 
-from core.keyboards import get_callback_btns, get_inlineMix_btns
-from core.database.models import User, Card
+from core.config import ConfigStore
+from core.keyboards import BACK_TO_MENU, YES_TO_MENU
+from core.database.models import User
 from core.database import orm_query as orm
-from core.utils import generate_main_menu
+from core.metrics import DRAWS, LIMIT_HITS
+from core.user_cache import users
+from core.utils import generate_main_menu, send_card_photo
+from services.draw import (
+    cooldown_start,
+    deck,
+    draw_card,
+    local_day,
+    to_utc_naive,
+    user_locks,
+)
 
 logger = logging.getLogger(__name__)
 
@@ -22,31 +29,16 @@ user_router = Router()
 
 
 @user_router.message(CommandStart())
-async def start_cmd(message: types.Message, session: AsyncSession):
+async def start_cmd(
+    message: types.Message, session: AsyncSession, config: ConfigStore
+):
     try:
-        main_menu_btns = await generate_main_menu(message.from_user.id, session)
-
-        with open("config.json", "r") as f:
-            data = json.load(f)
-
-        start_text = data.get("start_text")
-
-        user = await orm.orm_read(
-            session=session, model=User, tg_id=message.from_user.id
+        await users.register(session, message.from_user.id, message.from_user.username)
+        main_menu_btns = await generate_main_menu(
+            message.from_user.id, session, config
         )
 
-        if not user:
-            if message.from_user.username:
-                await orm.orm_create(
-                    session,
-                    User,
-                    {
-                        "tg_id": message.from_user.id,
-                        "username": message.from_user.username,
-                    },
-                )
-            else:
-                await orm.orm_create(session, User, {"tg_id": message.from_user.id})
+        start_text = config.current.start_text
 
         await message.answer(text=start_text)
         await message.answer("Делаем расклад?", reply_markup=main_menu_btns)
@@ -57,9 +49,16 @@ async def start_cmd(message: types.Message, session: AsyncSession):
 
 
 @user_router.message(Command("menu"))
-async def manu_cmd(message: types.Message, session: AsyncSession, state: FSMContext):
+async def manu_cmd(
+    message: types.Message,
+    session: AsyncSession,
+    state: FSMContext,
+    config: ConfigStore,
+):
     try:
-        main_menu_btns = await generate_main_menu(message.from_user.id, session)
+        main_menu_btns = await generate_main_menu(
+            message.from_user.id, session, config
+        )
         await state.clear()
         await message.answer("Делаем расклад?", reply_markup=main_menu_btns)
     except Exception:
@@ -70,12 +69,15 @@ async def manu_cmd(message: types.Message, session: AsyncSession, state: FSMCont
 
 @user_router.callback_query(F.data == "menu")
 async def start_callback(
-    callback: types.CallbackQuery, state: FSMContext, session: AsyncSession
+    callback: types.CallbackQuery,
+    state: FSMContext,
+    session: AsyncSession,
+    config: ConfigStore,
 ):
     try:
         await state.clear()
         main_menu_btns = await generate_main_menu(
-            callback.from_user.id, session=session
+            callback.from_user.id, session=session, config=config
         )
         await callback.message.edit_text("Делаем расклад?", reply_markup=main_menu_btns)
     except Exception:
@@ -85,102 +87,90 @@ async def start_callback(
 
 
 @user_router.callback_query(F.data == "card")
-async def callback_card(callback: types.CallbackQuery, session: AsyncSession):
+async def callback_card(
+    callback: types.CallbackQuery, session: AsyncSession, config: ConfigStore
+):
     try:
-        all_cards = await orm.orm_read(session=session, model=Card, as_iterable=True)
-        user = await orm.orm_read(
-            session=session, model=User, tg_id=callback.from_user.id, as_iterable=False
-        )
-        actual_time = datetime.now(timezone(timedelta(hours=2)))
-        # Convert to offset-naive datetime
-        actual_time_naive = actual_time.replace(tzinfo=None)
-        free_cards = []
-        exiting_cards = user.cards or {}
-        random_card = None
-
-        kyiv_time_zone = ZoneInfo("Europe/Kiev")
-        today_kyiv = datetime.now(kyiv_time_zone).date()
-
-        today_elements = {
-            key: value
-            for key, value in exiting_cards.items()
-            if datetime.fromisoformat(value).astimezone(kyiv_time_zone).date()
-            == today_kyiv
-        }
-
-        with open("config.json", "r") as f:
-            data = json.load(f)
-
-        cards_limit = int(data.get("cards_limit"))
+        # Double taps and retries of the same user queue up here. Across
+        # workers the daily_draw row taken below is locked until commit,
+        # so the second draw sees the first one in the cooldown.
+        async with user_locks(callback.from_user.id):
+            user = await users.load(session, callback.from_user.id)
+            actual_time = datetime.now(timezone(timedelta(hours=2)))
+            # Convert to offset-naive datetime
+            actual_time_naive = actual_time.replace(tzinfo=None)
+            today = local_day(actual_time)
+
+            cards_limit = config.current.cards_limit
+
+            if cards_limit is None:
+                cards_limit = 3
+
+            # The cached count never exceeds the real one, so a user known to
+            # be over the limit is turned away without a query
+            draws = None
+            if user.draws_on(today) < cards_limit:
+                # Taken up front, handed back below if no card is drawn
+                draws = await orm.orm_take_daily_slot(
+                    session, user.pk, today, cards_limit
+                )
 
-        if cards_limit is None:
-            cards_limit = 3
+            if draws is None:
+                LIMIT_HITS.inc()
+                await session.rollback()
+                users.update(callback.from_user.id, day=today, draws=cards_limit)
+                await callback.message.edit_text(
+                    "Воу-воу палехче, слишком много карт, пора и поработать :)",
+                    reply_markup=BACK_TO_MENU,
+                )
+                return
+
+            # if in db no cards
+            if not await deck.ids(session):
+                await session.rollback()
+                await callback.message.edit_text(
+                    "Карт нету",
+                    reply_markup=BACK_TO_MENU,
+                )
+                return
 
-        if len(today_elements) >= cards_limit:
-            await callback.message.edit_text(
-                "Воу-воу палехче, слишком много карт, пора и поработать :)",
-                reply_markup=get_callback_btns(btns={"Назад ⏪": "menu"}),
+            excluded = await orm.orm_drawn_card_ids(
+                session, user.pk, since=cooldown_start(actual_time)
             )
-            return
-
-        # if in db no cards
-        if not all_cards:
-            await callback.message.edit_text(
-                "Карт нету",
-                reply_markup=get_callback_btns(btns={"Назад ⏪": "menu"}),
+            random_card = await draw_card(session, excluded)
+
+            if random_card is None:
+                await session.rollback()
+                await callback.answer()
+                await callback.message.edit_text(
+                    "Карты закончились 😞",
+                    reply_markup=BACK_TO_MENU,
+                )
+                return
+
+            await orm.orm_add_draw(
+                session,
+                user.pk,
+                random_card.pk,
+                drawn_at=to_utc_naive(actual_time),
+                last_request=actual_time_naive,
             )
-            return
-
-        # if user has'nt cards
-        if not exiting_cards:
-            random.shuffle(all_cards)
-            random_card = random.choice(all_cards)
-        else:
-            # if user has cards
-            for card in all_cards:
-                # if card is not in exiting cards
-                if not str(card.pk) in exiting_cards.keys():
-                    free_cards.append(card)  # add to free_cards list
-                else:
-                    # if card is in exiting cards, check the freshness of the card by date (10 days)
-                    exiting_time = datetime.fromisoformat(exiting_cards[str(card.pk)])
-
-                    if (actual_time - exiting_time) > timedelta(days=10):
-                        free_cards.append(card)
-
-        if free_cards:
-            random.shuffle(free_cards)
-            random_card = random.choice(free_cards)
-            exiting_cards[random_card.pk] = actual_time.isoformat()
-        elif random_card is not None:
-            exiting_cards[random_card.pk] = actual_time.isoformat()
-        else:
-            await callback.answer()
-            await callback.message.edit_text(
-                "Карты закончились 😞",
-                reply_markup=get_callback_btns(btns={"Назад ⏪": "menu"}),
+            users.update(callback.from_user.id, day=today, draws=draws)
+            DRAWS.labels("user").inc()
+            logger.info(
+                f"User {user.pk}: Updated last_request to {actual_time.isoformat()}.",
+                extra={"sampled": True},
             )
-            return
-
-        await orm.orm_update(
-            session=session,
-            model=User,
-            pk=user.pk,
-            data={"cards": exiting_cards, "last_request": actual_time_naive},
-        )
-        logger.info(
-            f"User {user.pk}: Updated last_request to {actual_time.isoformat()}."
-        )
-
-        photo = FSInputFile(random_card.image, filename="card.jpg")
 
-        await callback.message.delete()
-        await callback.message.answer_photo(photo=photo)
-        await callback.message.answer(text=random_card.description)
-        await callback.message.answer(
-            text="Вернуться в меню?",
-            reply_markup=get_callback_btns(btns={"Да": "menu"}),
-        )
+            await callback.message.delete()
+            await send_card_photo(
+                callback.bot, callback.message.chat.id, random_card, session
+            )
+            await callback.message.answer(text=random_card.description)
+            await callback.message.answer(
+                text="Вернуться в меню?",
+                reply_markup=YES_TO_MENU,
+            )
 
     except Exception:
         logger.error("Error in callback_card")
@@ -190,12 +180,13 @@ async def callback_card(callback: types.CallbackQuery, session: AsyncSession):
 
 @user_router.callback_query(F.data == "subscribe")
 async def callback_subscribe(
-    callback: types.CallbackQuery, state: FSMContext, session: AsyncSession
+    callback: types.CallbackQuery,
+    state: FSMContext,
+    session: AsyncSession,
+    config: ConfigStore,
 ):
     try:
-        user = await orm.orm_read(
-            session=session, model=User, tg_id=callback.from_user.id, as_iterable=False
-        )
+        user = await users.load(session, callback.from_user.id)
 
         await orm.orm_update(
             session=session,
@@ -203,9 +194,10 @@ async def callback_subscribe(
             pk=user.pk,
             data={"subscription": True},
         )
+        users.update(callback.from_user.id, subscription=True)
 
         await callback.answer("Вы подписались на ежедневную карту ✅🎉")
-        await start_callback(callback, state, session)
+        await start_callback(callback, state, session, config)
     except Exception:
         logger.error("Error in callback_subscribe")
         logger.error(traceback.format_exc())
@@ -214,12 +206,13 @@ async def callback_subscribe(
 
 @user_router.callback_query(F.data == "unsubscribe")
 async def callback_unsubscribe(
-    callback: types.CallbackQuery, state: FSMContext, session: AsyncSession
+    callback: types.CallbackQuery,
+    state: FSMContext,
+    session: AsyncSession,
+    config: ConfigStore,
 ):
     try:
-        user = await orm.orm_read(
-            session=session, model=User, tg_id=callback.from_user.id, as_iterable=False
-        )
+        user = await users.load(session, callback.from_user.id)
 
         await orm.orm_update(
             session=session,
@@ -227,9 +220,10 @@ async def callback_unsubscribe(
             pk=user.pk,
             data={"subscription": False},
         )
+        users.update(callback.from_user.id, subscription=False)
 
         await callback.answer("Вы отписались от ежедневной карты ❌")
-        await start_callback(callback, state, session)
+        await start_callback(callback, state, session, config)
     except Exception:
         logger.error("Error in callback_unsubscribe")
         logger.error(traceback.format_exc())
@@ -238,12 +232,9 @@ async def callback_unsubscribe(
 
 # HELP COMMAND FOR MESSAGE
 @user_router.message(Command("help"))
-async def help_cmd(message: types.Message):
+async def help_cmd(message: types.Message, config: ConfigStore):
     try:
-        with open("config.json", "r") as f:
-            data = json.load(f)
-
-        help_text = data.get("help_text")
+        help_text = config.current.help_text
 
         if str(message.from_user.id) in message.bot.my_admins_list:
             await message.answer(
@@ -259,24 +250,21 @@ async def help_cmd(message: types.Message):
 
 # HELP COMMAND FOR CALLBACK
 @user_router.callback_query(F.data == "help")
-async def help_cmd(callback: types.CallbackQuery):
+async def help_cmd(callback: types.CallbackQuery, config: ConfigStore):
     try:
-        with open("config.json", "r") as f:
-            data = json.load(f)
-
-        help_text = data.get("help_text")
+        help_text = config.current.help_text
 
         if str(callback.from_user.id) in callback.bot.my_admins_list:
             await callback.message.edit_text(
                 text=f"{help_text}\n\n<b>Команды для админов</b>\n/admin - Админ панель",
                 parse_mode="HTML",
-                reply_markup=get_callback_btns(btns={"Назад ⏪": "menu"}),
+                reply_markup=BACK_TO_MENU,
             )
         else:
             await callback.message.edit_text(
                 help_text,
                 parse_mode="HTML",
-                reply_markup=get_callback_btns(btns={"Назад ⏪": "menu"}),
+                reply_markup=BACK_TO_MENU,
             )
     except Exception:
         logger.error("Error in help_cmd")
@@ -1,4 +1,6 @@
-from aiogram.types import InlineKeyboardButton
+from typing import Callable, Hashable
+
+from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 
 
@@ -43,4 +45,32 @@ def get_inlineMix_btns(
         else:
             keyboard.add(InlineKeyboardButton(text=text, callback_data=value))
 
-    return keyboard.adjust(*sizes).as_markup()
\ No newline at end of file
+    return keyboard.adjust(*sizes).as_markup()
+
+
+# Markups are immutable once sent, so one instance can be shared by all
+# handlers. Keys carry everything a markup depends on (config version,
+# subscription...), a stale entry is simply never asked for again.
+_markups: dict[Hashable, InlineKeyboardMarkup] = {}
+MARKUPS_LIMIT = 256
+
+
+def cached_markup(key: Hashable, build: Callable[[], InlineKeyboardMarkup]):
+    markup = _markups.get(key)
+
+    if markup is None:
+        if len(_markups) >= MARKUPS_LIMIT:
+            _markups.clear()
+
+        markup = _markups[key] = build()
+
+    return markup
+
+
+def invalidate_markups():
+    _markups.clear()
+
+
+BACK_TO_MENU = get_callback_btns(btns={"Назад ⏪": "menu"})
+YES_TO_MENU = get_callback_btns(btns={"Да": "menu"})
+BACK_TO_EDIT_CARDS = get_callback_btns(btns={"Назад": "edit_cards"})
@@ -0,0 +1,96 @@
+import atexit
+import json
+import logging
+import os
+import queue
+import random
+from datetime import datetime, timezone
+from logging.handlers import (
+    QueueHandler,
+    QueueListener,
+    RotatingFileHandler,
+    TimedRotatingFileHandler,
+)
+
+TEXT_FORMAT = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            # QueueHandler has already appended any traceback to the message
+            "message": record.getMessage(),
+        }
+
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class SampleFilter(logging.Filter):
+    """Keeps a share of the records logged with ``extra={"sampled": True}``.
+
+    Meant for per-draw and per-user info lines, warnings and errors are
+    always kept.
+    """
+
+    def __init__(self, rate: float):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if not getattr(record, "sampled", False) or record.levelno > logging.INFO:
+            return True
+
+        return random.random() < self.rate
+
+
+def _file_handler(path: str) -> logging.Handler:
+    # LOG_ROTATE_WHEN=midnight (or h, d...) rotates by time, otherwise by size
+    when = os.getenv("LOG_ROTATE_WHEN")
+    backups = int(os.getenv("LOG_BACKUP_COUNT", "7"))
+
+    if when:
+        return TimedRotatingFileHandler(
+            path, when=when, backupCount=backups, encoding="utf-8"
+        )
+
+    max_bytes = int(os.getenv("LOG_MAX_BYTES", str(10 * 1024 * 1024)))
+    return RotatingFileHandler(
+        path, maxBytes=max_bytes, backupCount=backups, encoding="utf-8"
+    )
+
+
+def setup_logging(path: str = "logs/bot.log") -> QueueListener:
+    """Log through a queue, files and console are written by a thread.
+
+    The event loop only puts records on the queue, so a slow disk doesn't
+    stall handlers.
+    """
+    file_handler = _file_handler(path)
+    if os.getenv("LOG_FORMAT", "json") == "json":
+        file_handler.setFormatter(JsonFormatter())
+    else:
+        file_handler.setFormatter(logging.Formatter(TEXT_FORMAT))
+
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(logging.Formatter(TEXT_FORMAT))
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = QueueHandler(log_queue)
+    queue_handler.addFilter(SampleFilter(float(os.getenv("LOG_SAMPLE_RATE", "0.1"))))
+
+    root = logging.getLogger()
+    root.setLevel(os.getenv("LOG_LEVEL", "INFO"))
+    root.handlers = [queue_handler]
+
+    listener = QueueListener(
+        log_queue, file_handler, stream_handler, respect_handler_level=True
+    )
+    listener.start()
+    # Writes out what is still queued when the process exits
+    atexit.register(listener.stop)
+    return listener
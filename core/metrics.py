@@ -0,0 +1,164 @@
+import logging
+import os
+import time
+
+from aiohttp import web
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Gauge, Histogram
+from prometheus_client import generate_latest
+from sqlalchemy import event
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.ext.asyncio import AsyncEngine
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+
+logger = logging.getLogger(__name__)
+
+# Queries slower than this are logged with their SQL
+SLOW_QUERY_SECONDS = float(os.getenv("DB_SLOW_QUERY_MS", "200")) / 1000
+
+DB_QUERY_SECONDS = Histogram(
+    "bot_db_query_seconds",
+    "Time spent executing SQL statements",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5),
+)
+DB_SLOW_QUERIES = Counter(
+    "bot_db_slow_queries_total", "SQL statements slower than DB_SLOW_QUERY_MS"
+)
+DB_POOL_WAIT_SECONDS = Histogram(
+    "bot_db_pool_wait_seconds",
+    "Time spent waiting for a connection from the pool",
+    buckets=(0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30),
+)
+DB_POOL_TIMEOUTS = Counter(
+    "bot_db_pool_timeouts_total", "Connection requests that hit the pool timeout"
+)
+DB_POOL_CHECKOUTS = Counter(
+    "bot_db_pool_checkouts_total", "Connections handed out by the pool"
+)
+DB_POOL_IN_USE = Gauge("bot_db_pool_in_use", "Connections currently checked out")
+DB_POOL_SIZE = Gauge("bot_db_pool_size", "Connections kept open by the pool")
+DB_POOL_OVERFLOW = Gauge(
+    "bot_db_pool_overflow", "Connections opened above the pool size"
+)
+
+
+HANDLER_SECONDS = Histogram(
+    "bot_handler_seconds",
+    "Time spent in a handler",
+    ["router", "handler", "event"],
+    buckets=(0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10),
+)
+HANDLER_ERRORS = Counter(
+    "bot_handler_errors_total",
+    "Exceptions that escaped a handler",
+    ["router", "handler", "event"],
+)
+TELEGRAM_API_SECONDS = Histogram(
+    "bot_telegram_api_seconds",
+    "Latency of Telegram Bot API calls",
+    ["method", "status"],
+    buckets=(0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30),
+)
+DRAWS = Counter("bot_draws_total", "Cards drawn", ["source"])
+LIMIT_HITS = Counter("bot_limit_hits_total", "Draws refused by cards_limit")
+BROADCAST_SENDS = Counter(
+    "bot_broadcast_sends_total", "Broadcast deliveries", ["broadcast", "status"]
+)
+USER_CACHE_HITS = Gauge("bot_user_cache_hits", "User lookups answered by the cache")
+USER_CACHE_MISSES = Gauge(
+    "bot_user_cache_misses", "User lookups that went to the database"
+)
+USER_CACHE_HIT_RATE = Gauge("bot_user_cache_hit_rate", "Share of cached user lookups")
+USER_CACHE_SIZE = Gauge("bot_user_cache_size", "Users held in the cache")
+SESSION_UPDATES = Gauge("bot_session_updates", "Updates seen by DataBaseSession")
+SESSIONS_USED = Gauge("bot_sessions_used", "Updates that opened a database session")
+SESSION_QUERIES = Gauge("bot_session_queries", "Queries run through update sessions")
+SESSION_HELD_SECONDS = Gauge(
+    "bot_session_held_seconds", "Time update sessions were held open"
+)
+
+
+class InstrumentedQueuePool(AsyncAdaptedQueuePool):
+    """Queue pool that records how long callers wait for a connection."""
+
+    def _do_get(self):
+        started = time.perf_counter()
+
+        try:
+            return super()._do_get()
+        except PoolTimeoutError:
+            DB_POOL_TIMEOUTS.inc()
+            raise
+        finally:
+            DB_POOL_WAIT_SECONDS.observe(time.perf_counter() - started)
+
+
+def instrument_engine(engine: AsyncEngine) -> None:
+    sync_engine = engine.sync_engine
+    pool = sync_engine.pool
+
+    @event.listens_for(pool, "checkout")
+    def on_checkout(*args):
+        DB_POOL_CHECKOUTS.inc()
+        DB_POOL_IN_USE.inc()
+
+    @event.listens_for(pool, "checkin")
+    def on_checkin(*args):
+        DB_POOL_IN_USE.dec()
+
+    if isinstance(pool, AsyncAdaptedQueuePool):
+        DB_POOL_SIZE.set_function(pool.size)
+        DB_POOL_OVERFLOW.set_function(lambda: max(pool.overflow(), 0))
+
+    @event.listens_for(sync_engine, "before_cursor_execute")
+    def before_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+    @event.listens_for(sync_engine, "after_cursor_execute")
+    def after_execute(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info["query_started"].pop()
+        DB_QUERY_SECONDS.observe(elapsed)
+
+        if elapsed >= SLOW_QUERY_SECONDS:
+            DB_SLOW_QUERIES.inc()
+            logger.warning(f"Slow query ({elapsed * 1000:.0f}ms): {statement}")
+
+    @event.listens_for(sync_engine, "handle_error")
+    def on_error(context):
+        if context.connection is not None:
+            started = context.connection.info.get("query_started")
+            if started:
+                started.pop()
+
+
+def instrument_user_cache(cache) -> None:
+    # Read on scrape from the cache's own counters
+    USER_CACHE_HITS.set_function(lambda: cache.hits)
+    USER_CACHE_MISSES.set_function(lambda: cache.misses)
+    USER_CACHE_HIT_RATE.set_function(lambda: cache.hit_rate)
+    USER_CACHE_SIZE.set_function(lambda: len(cache))
+
+
+def instrument_sessions(middleware) -> None:
+    # Totals of the DataBaseSession middleware
+    SESSION_UPDATES.set_function(lambda: middleware.updates)
+    SESSIONS_USED.set_function(lambda: middleware.sessions_used)
+    SESSION_QUERIES.set_function(lambda: middleware.queries)
+    SESSION_HELD_SECONDS.set_function(lambda: middleware.held)
+
+
+async def metrics_handler(request: web.Request) -> web.Response:
+    return web.Response(
+        body=generate_latest(), headers={"Content-Type": CONTENT_TYPE_LATEST}
+    )
+
+
+async def start_metrics_server(host: str, port: int) -> web.AppRunner:
+    # Polling mode has no web server of its own, metrics get a small one
+    app = web.Application()
+    app.router.add_get("/metrics", metrics_handler)
+
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logger.info(f"Metrics are served on {host}:{port}/metrics")
+    return runner
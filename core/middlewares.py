@@ -1,14 +1,188 @@
+import logging
+import time
 from typing import Any, Awaitable, Callable, Dict
 
-from aiogram import BaseMiddleware
-from aiogram.types import Message, TelegramObject
+from aiogram import BaseMiddleware, Bot
+from aiogram.client.session.middlewares.base import (
+    BaseRequestMiddleware,
+    NextRequestMiddlewareType,
+)
+from aiogram.exceptions import TelegramAPIError
+from aiogram.methods import TelegramMethod
+from aiogram.types import CallbackQuery, Message, TelegramObject, Update
 
-from sqlalchemy.ext.asyncio import async_sessionmaker
+from sqlalchemy import Select
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+from core.metrics import HANDLER_ERRORS, HANDLER_SECONDS, TELEGRAM_API_SECONDS
+from core.tracing import trace
+
+logger = logging.getLogger(__name__)
+
+
+class LazySession:
+    """Stand-in for AsyncSession that is only created on first use.
+
+    Plain reads give their connection back to the pool as soon as the rows
+    are fetched, so a handler that reads and then talks to Telegram doesn't
+    keep a connection checked out. Once something is written the session
+    behaves as usual until it is committed.
+    """
+
+    def __init__(self, session_pool: async_sessionmaker):
+        self._session_pool = session_pool
+        self._session: AsyncSession | None = None
+        self._checked_out_at = None
+        self._pending_writes = False
+        self.queries = 0
+        self.held = 0.0
+
+    @property
+    def used(self) -> bool:
+        return self._session is not None
+
+    def _get_session(self) -> AsyncSession:
+        if self._session is None:
+            self._session = self._session_pool()
+
+        if self._checked_out_at is None:
+            self._checked_out_at = time.perf_counter()
+
+        return self._session
+
+    def _release(self) -> None:
+        if self._checked_out_at is not None:
+            self.held += time.perf_counter() - self._checked_out_at
+            self._checked_out_at = None
+
+    async def _after_read(self) -> None:
+        session = self._session
+        if session.new or session.dirty or session.deleted or self._pending_writes:
+            return
+
+        # Loaded objects stay usable after close, expire_on_commit is off
+        await session.close()
+        self._release()
+
+    async def execute(self, statement, *args, **kwargs):
+        session = self._get_session()
+        result = await session.execute(statement, *args, **kwargs)
+        self.queries += 1
+
+        if isinstance(statement, Select):
+            await self._after_read()
+        else:
+            self._pending_writes = True
+
+        return result
+
+    async def scalar(self, statement, *args, **kwargs):
+        result = await self.execute(statement, *args, **kwargs)
+        return result.scalar()
+
+    async def scalars(self, statement, *args, **kwargs):
+        result = await self.execute(statement, *args, **kwargs)
+        return result.scalars()
+
+    async def get(self, *args, **kwargs):
+        session = self._get_session()
+        obj = await session.get(*args, **kwargs)
+        self.queries += 1
+        await self._after_read()
+        return obj
+
+    async def commit(self) -> None:
+        await self._get_session().commit()
+        self._pending_writes = False
+        self._release()
+
+    async def rollback(self) -> None:
+        if self._session is not None:
+            await self._session.rollback()
+            self._pending_writes = False
+            self._release()
+
+    async def close(self) -> None:
+        if self._session is not None:
+            await self._session.close()
+            self._release()
+
+    def __getattr__(self, name):
+        return getattr(self._get_session(), name)
+
+
+class CallbackDedupe(BaseMiddleware):
+    """Drops callback queries that were already handled.
+
+    Telegram redelivers updates that weren't acknowledged in time, those
+    carry the same callback id. For the buttons in ``tap_guarded`` a double
+    tap (two ids for the same button of the same message) is dropped too
+    within ``tap_window`` seconds, other buttons like the day toggles may
+    be tapped repeatedly on purpose.
+    """
+
+    def __init__(
+        self,
+        ttl: float = 60.0,
+        tap_window: float = 2.0,
+        tap_guarded: frozenset[str] = frozenset({"card"}),
+    ):
+        self.ttl = ttl
+        self.tap_window = tap_window
+        self.tap_guarded = tap_guarded
+        self._seen: dict[tuple, float] = {}
+
+    def _check(self, key: tuple, ttl: float, now: float) -> bool:
+        if self._seen.get(key, 0) > now:
+            return False
+
+        self._seen[key] = now + ttl
+        return True
+
+    def _is_duplicate(self, event: CallbackQuery, now: float) -> bool:
+        if not self._check(("id", event.id), self.ttl, now):
+            return True
+
+        if event.data not in self.tap_guarded:
+            return False
+
+        message_id = event.message.message_id if event.message else None
+        tap = (event.from_user.id, message_id, event.data)
+        return not self._check(tap, self.tap_window, now)
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: CallbackQuery,
+        data: Dict[str, Any],
+    ) -> Any:
+        now = time.monotonic()
+
+        if len(self._seen) > 10000:
+            self._seen = {key: ts for key, ts in self._seen.items() if ts > now}
+
+        if self._is_duplicate(event, now):
+            logger.debug(f"Dropped duplicate callback {event.id} ({event.data})")
+
+            # Stops the client's spinner, a redelivered id may be answered
+            # already
+            try:
+                await event.answer()
+            except TelegramAPIError:
+                pass
+
+            return None
+
+        return await handler(event, data)
 
 
 class DataBaseSession(BaseMiddleware):
     def __init__(self, session_pool: async_sessionmaker):
         self.session_pool = session_pool
+        self.updates = 0
+        self.sessions_used = 0
+        self.queries = 0
+        self.held = 0.0
 
     async def __call__(
         self,
@@ -16,6 +190,99 @@ class DataBaseSession(BaseMiddleware):
         event: TelegramObject,
         data: Dict[str, Any],
     ) -> Any:
-        async with self.session_pool() as session:
-            data["session"] = session
+        session = LazySession(self.session_pool)
+        data["session"] = session
+
+        try:
+            return await handler(event, data)
+        finally:
+            await session.close()
+
+            self.updates += 1
+            if session.used:
+                self.sessions_used += 1
+                self.queries += session.queries
+                self.held += session.held
+
+            logger.debug(
+                f"Update {getattr(event, 'update_id', '?')}: "
+                f"session used={session.used}, queries={session.queries}, "
+                f"held={session.held * 1000:.1f}ms"
+            )
+
+
+class TracingMiddleware(BaseMiddleware):
+    """Opens the root span of an update, registered as an outer middleware.
+
+    Handler, SQL and Bot API spans recorded while it runs become its
+    children.
+    """
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: Update,
+        data: Dict[str, Any],
+    ) -> Any:
+        attributes = {"update_id": event.update_id, "event": event.event_type}
+        if event.callback_query:
+            attributes["callback_data"] = event.callback_query.data
+
+        with trace("update", root=True, **attributes):
             return await handler(event, data)
+
+
+class HandlerMetrics(BaseMiddleware):
+    """Times handlers for metrics and traces.
+
+    Registered as an inner middleware of router observers.
+    """
+
+    def __init__(self, event: str):
+        self.event = event
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        callback = data["handler"].callback
+        labels = (callback.__module__.rsplit(".", 1)[-1], callback.__name__, self.event)
+        started = time.perf_counter()
+
+        try:
+            with trace(f"handler {labels[0]}.{labels[1]}"):
+                return await handler(event, data)
+        except Exception:
+            HANDLER_ERRORS.labels(*labels).inc()
+            raise
+        finally:
+            HANDLER_SECONDS.labels(*labels).observe(time.perf_counter() - started)
+
+
+class ApiMetrics(BaseRequestMiddleware):
+    """Times every Bot API call for metrics and traces.
+
+    Registered on ``bot.session``.
+    """
+
+    async def __call__(
+        self,
+        make_request: NextRequestMiddlewareType,
+        bot: Bot,
+        method: TelegramMethod,
+    ):
+        started = time.perf_counter()
+        status = "ok"
+
+        try:
+            with trace(f"telegram {method.__api_method__}"):
+                return await make_request(bot, method)
+        except TelegramAPIError as e:
+            status = type(e).__name__
+            raise
+        finally:
+            TELEGRAM_API_SECONDS.labels(method.__api_method__, status).observe(
+                time.perf_counter() - started
+            )
@@ -0,0 +1,88 @@
+import logging
+import os
+from typing import Any, Dict, Optional
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import (
+    BaseStorage,
+    DefaultKeyBuilder,
+    StateType,
+    StorageKey,
+)
+from aiogram.fsm.storage.memory import MemoryStorage
+from sqlalchemy.ext.asyncio import async_sessionmaker
+
+from core.database.models import FsmState
+
+logger = logging.getLogger(__name__)
+
+
+class SQLStorage(BaseStorage):
+    """FSM storage in the bot's own database (fsm_state table)."""
+
+    def __init__(self, session_pool: async_sessionmaker):
+        self.session_pool = session_pool
+        self.key_builder = DefaultKeyBuilder(with_destiny=True)
+
+    async def _get(self, key: StorageKey) -> Optional[FsmState]:
+        async with self.session_pool() as session:
+            return await session.get(FsmState, self.key_builder.build(key))
+
+    async def _save(self, key: StorageKey, **values) -> None:
+        async with self.session_pool() as session:
+            pk = self.key_builder.build(key)
+            row = await session.get(FsmState, pk)
+            stored = row is not None
+
+            if row is None:
+                row = FsmState(pk=pk)
+
+            for name, value in values.items():
+                setattr(row, name, value)
+
+            # Empty state and data: no row, only a stored one is deleted
+            if row.state is None and not row.data:
+                if not stored:
+                    return
+
+                await session.delete(row)
+            elif not stored:
+                session.add(row)
+
+            await session.commit()
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        await self._save(key, state=state.state if isinstance(state, State) else state)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        row = await self._get(key)
+        return row.state if row else None
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        await self._save(key, data=data.copy())
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        row = await self._get(key)
+        return dict(row.data) if row and row.data else {}
+
+    async def close(self) -> None:
+        pass
+
+
+def build_storage(session_pool: async_sessionmaker) -> BaseStorage:
+    # memory | redis | sql
+    kind = os.getenv("FSM_STORAGE", "memory")
+
+    if kind == "redis":
+        # Imported here, the other backends don't need a redis client set up
+        from aiogram.fsm.storage.redis import RedisStorage
+
+        return RedisStorage.from_url(os.getenv("REDIS_URL", "redis://localhost:6379/0"))
+
+    if kind == "sql":
+        return SQLStorage(session_pool)
+
+    if kind != "memory":
+        logger.warning(f"Unknown FSM_STORAGE={kind!r}, using memory storage.")
+
+    return MemoryStorage()
@@ -0,0 +1,170 @@
+import atexit
+import json
+import os
+import queue
+import random
+import secrets
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from sqlalchemy import event
+
+# Off unless TRACING=1, spans then go to TRACE_FILE as JSON lines with
+# OTLP field names, one span per line
+TRACING = os.getenv("TRACING", "0") == "1"
+TRACE_FILE = os.getenv("TRACE_FILE", "logs/traces.jsonl")
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "1.0"))
+
+
+class Span:
+    __slots__ = (
+        "trace_id",
+        "span_id",
+        "parent_id",
+        "name",
+        "attributes",
+        "start_ns",
+        "end_ns",
+        "status",
+    )
+
+    def __init__(self, name: str, parent: "Span | None" = None, **attributes):
+        self.trace_id = parent.trace_id if parent else secrets.token_hex(16)
+        self.span_id = secrets.token_hex(8)
+        self.parent_id = parent.span_id if parent else None
+        self.name = name
+        self.attributes = attributes
+        self.start_ns = time.time_ns()
+        self.end_ns = None
+        self.status = "ok"
+
+    def to_dict(self) -> dict:
+        return {
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "parentSpanId": self.parent_id,
+            "name": self.name,
+            "startTimeUnixNano": self.start_ns,
+            "endTimeUnixNano": self.end_ns,
+            "durationMs": round((self.end_ns - self.start_ns) / 1e6, 3),
+            "status": self.status,
+            "attributes": self.attributes,
+        }
+
+
+class SpanExporter:
+    """Writes finished spans from a background thread, like the log queue."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._queue = queue.SimpleQueue()
+        self._thread = None
+
+    def start(self) -> None:
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        atexit.register(self.stop)
+
+    def export(self, span: Span) -> None:
+        self._queue.put(span.to_dict())
+
+    def stop(self) -> None:
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join(timeout=5)
+            self._thread = None
+
+    def _run(self) -> None:
+        with open(self.path, "a", encoding="utf-8") as f:
+            while True:
+                item = self._queue.get()
+                if item is None:
+                    return
+
+                f.write(json.dumps(item, ensure_ascii=False, default=str) + "\n")
+
+                # Flush once the backlog is written, not after every span
+                if self._queue.empty():
+                    f.flush()
+
+
+_current: ContextVar[Span | None] = ContextVar("current_span", default=None)
+exporter = SpanExporter(TRACE_FILE)
+
+if TRACING:
+    exporter.start()
+
+
+def current_span() -> Span | None:
+    return _current.get()
+
+
+def start_span(name: str, **attributes) -> Span | None:
+    """Open a child of the current span, None when no trace is recorded."""
+    parent = _current.get()
+    if parent is None:
+        return None
+
+    return Span(name, parent, **attributes)
+
+
+def end_span(span: Span | None, status: str = "ok") -> None:
+    if span is None:
+        return
+
+    span.end_ns = time.time_ns()
+    span.status = status
+    exporter.export(span)
+
+
+@contextmanager
+def trace(name: str, root: bool = False, **attributes):
+    """Span around a block. ``root`` starts a new trace, e.g. per update."""
+    if root:
+        if not TRACING or random.random() >= TRACE_SAMPLE_RATE:
+            yield None
+            return
+
+        span = Span(name, **attributes)
+    else:
+        span = start_span(name, **attributes)
+        if span is None:
+            yield None
+            return
+
+    token = _current.set(span)
+    status = "ok"
+
+    try:
+        yield span
+    except BaseException as e:
+        status = type(e).__name__
+        raise
+    finally:
+        _current.reset(token)
+        end_span(span, status)
+
+
+def trace_engine(engine) -> None:
+    # A leaf span per SQL statement, under whatever span runs the query
+    sync_engine = engine.sync_engine
+
+    @event.listens_for(sync_engine, "before_cursor_execute")
+    def before_execute(conn, cursor, statement, parameters, context, executemany):
+        span = start_span("db.query", statement=statement[:500])
+        conn.info.setdefault("spans", []).append(span)
+
+    @event.listens_for(sync_engine, "after_cursor_execute")
+    def after_execute(conn, cursor, statement, parameters, context, executemany):
+        end_span(conn.info["spans"].pop())
+
+    @event.listens_for(sync_engine, "handle_error")
+    def on_error(context):
+        if context.connection is not None and context.connection.info.get("spans"):
+            end_span(
+                context.connection.info["spans"].pop(),
+                type(context.original_exception).__name__,
+            )
@@ -0,0 +1,166 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from datetime import date
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from core.database import orm_query as orm
+from core.database.engine import session_maker
+from core.database.models import User
+
+logger = logging.getLogger(__name__)
+
+
+class CachedUser:
+    __slots__ = ("pk", "subscription", "username", "day", "draws", "loaded_at")
+
+    def __init__(self, pk: int, subscription: bool, username: str | None):
+        self.pk = pk
+        self.subscription = subscription
+        self.username = username
+        # Draws counted on ``day``, never more than the real daily_draw count
+        self.day: date | None = None
+        self.draws = 0
+        self.loaded_at = time.monotonic()
+
+    def draws_on(self, day: date) -> int:
+        return self.draws if self.day == day else 0
+
+
+class UserCache:
+    """Recently seen users by tg_id, least recently used dropped first.
+
+    Holds what the hot handlers need, so they skip the user lookup. Handlers
+    that change a user write through with :meth:`update`. Entries expire
+    after ``ttl`` seconds to pick up changes made by other workers.
+    """
+
+    def __init__(self, maxsize: int = 50000, ttl: float = 300.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._users: OrderedDict[int, CachedUser] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._users)
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def get(self, tg_id: int) -> CachedUser | None:
+        user = self._users.get(tg_id)
+
+        if user is None or time.monotonic() - user.loaded_at > self.ttl:
+            self._users.pop(tg_id, None)
+            self.misses += 1
+            return None
+
+        self._users.move_to_end(tg_id)
+        self.hits += 1
+        return user
+
+    def put(
+        self, tg_id: int, pk: int, subscription: bool, username: str | None
+    ) -> CachedUser:
+        user = self._users[tg_id] = CachedUser(pk, subscription, username)
+        self._users.move_to_end(tg_id)
+
+        if len(self._users) > self.maxsize:
+            self._users.popitem(last=False)
+
+        return user
+
+    def update(self, tg_id: int, **fields) -> None:
+        user = self._users.get(tg_id)
+
+        if user is not None:
+            for name, value in fields.items():
+                setattr(user, name, value)
+
+    def discard(self, tg_id: int) -> None:
+        self._users.pop(tg_id, None)
+
+    async def load(self, session: AsyncSession, tg_id: int) -> CachedUser | None:
+        user = self.get(tg_id)
+        if user is not None:
+            return user
+
+        result = await session.execute(
+            select(User.pk, User.subscription, User.username).where(User.tg_id == tg_id)
+        )
+        row = result.first()
+
+        if row is None:
+            return None
+
+        return self.put(tg_id, row.pk, row.subscription, row.username)
+
+    async def register(
+        self, session: AsyncSession, tg_id: int, username: str | None
+    ) -> CachedUser:
+        user = self.get(tg_id)
+
+        if user is None:
+            row = await orm.orm_get_or_create_user(session, tg_id, username)
+            user = self.put(tg_id, row.pk, row.subscription, row.username)
+
+        if user.username != username:
+            user.username = username
+            usernames.add(user.pk, username)
+
+        return user
+
+
+class UsernameBuffer:
+    """Username changes written in one batch instead of one by one.
+
+    Changes are flushed ``flush_delay`` seconds after the first one, or
+    right away once ``max_size`` are pending. :meth:`flush` on shutdown
+    writes the rest.
+    """
+
+    def __init__(self, flush_delay: float = 10.0, max_size: int = 500):
+        self.flush_delay = flush_delay
+        self.max_size = max_size
+        self._pending: dict[int, str | None] = {}
+        self._flush_lock = asyncio.Lock()
+        self._flush_task = None
+
+    def add(self, user_pk: int, username: str | None) -> None:
+        self._pending[user_pk] = username
+
+        if len(self._pending) >= self.max_size:
+            asyncio.create_task(self.flush())
+        elif self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._delayed_flush())
+
+    async def _delayed_flush(self) -> None:
+        await asyncio.sleep(self.flush_delay)
+        await self.flush()
+
+    async def flush(self) -> None:
+        async with self._flush_lock:
+            if not self._pending:
+                return
+
+            pending, self._pending = self._pending, {}
+            rows = [{"pk": pk, "username": name} for pk, name in pending.items()]
+
+            try:
+                async with session_maker() as session:
+                    await orm.orm_bulk_update(session, User, rows)
+            except Exception:
+                logger.exception(f"Failed to update {len(rows)} usernames")
+                return
+
+            logger.debug(f"Updated {len(rows)} usernames")
+
+
+users = UserCache()
+usernames = UsernameBuffer()
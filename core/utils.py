@@ -1,33 +1,50 @@
-import json
+import logging
 import re
 
+from aiogram import Bot
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.types import FSInputFile, Message
 from sqlalchemy.ext.asyncio import AsyncSession
 from bs4 import BeautifulSoup
 
-from core.keyboards import get_inlineMix_btns
-from core.database.models import User
+from core.config import BotConfig, ConfigStore
+from core.keyboards import cached_markup, get_inlineMix_btns
+from core.database.models import Card
 from core.database import orm_query as orm
+from core.user_cache import users
 
+logger = logging.getLogger(__name__)
 
-async def generate_main_menu(telegram_id: int, session: AsyncSession):
-    user = await orm.orm_read(session=session, model=User, tg_id=telegram_id)
+
+async def generate_main_menu(
+    telegram_id: int, session: AsyncSession, config: ConfigStore
+):
+    # Known users come from the cache, so the menu usually costs no query
+    user = await users.load(session, telegram_id)
+    # Unknown users get the unsubscribe button, as before
+    subscribed = user is None or user.subscription
+
+    return cached_markup(
+        ("main_menu", config.version, subscribed),
+        lambda: _build_main_menu(config.current, subscribed),
+    )
+
+
+def _build_main_menu(data: BotConfig, subscribed: bool):
     sub_text = ""
     sub_callback = ""
 
-    with open("config.json", "r") as f:
-        data = json.load(f)
-
-    if data.get("buy_cards_link"):
-        buy_cards_link = data["buy_cards_link"]
+    if data.buy_cards_link:
+        buy_cards_link = data.buy_cards_link
     else:
         buy_cards_link = "https://example.com/"
 
-    if data.get("full_card_link"):
-        full_card_link = data["full_card_link"]
+    if data.full_card_link:
+        full_card_link = data.full_card_link
     else:
         full_card_link = "https://example.com/"
 
-    if user and not user.subscription:
+    if not subscribed:
         sub_text = "🔔 Подписаться на ежедневную карту 🔔"
         sub_callback = "subscribe"
     else:
@@ -48,6 +65,36 @@ async def generate_main_menu(telegram_id: int, session: AsyncSession):
     return main_menu_btns
 
 
+async def send_card_photo(
+    bot: Bot, chat_id: int, card: Card, session: AsyncSession | None, **kwargs
+) -> Message:
+    # Reuse the file_id Telegram gave us for the first upload of this card
+    if card.file_id:
+        try:
+            return await bot.send_photo(chat_id=chat_id, photo=card.file_id, **kwargs)
+        except TelegramBadRequest as e:
+            # Telegram words a stale or foreign file_id in several ways, so
+            # any rejection gets exactly one retry with the file itself. A
+            # request that is bad for another reason fails again there.
+            logger.warning(
+                f"Card {card.pk}: file_id rejected ({e.message}), uploading again."
+            )
+
+    photo = FSInputFile(card.image, filename="card.jpg")
+    sent = await bot.send_photo(chat_id=chat_id, photo=photo, **kwargs)
+    file_id = sent.photo[-1].file_id
+
+    if file_id != card.file_id:
+        # Without a session the caller persists card.file_id itself
+        if session is not None:
+            await orm.orm_update(
+                session=session, model=Card, pk=card.pk, data={"file_id": file_id}
+            )
+        card.file_id = file_id
+
+    return sent
+
+
 def clean_html(input_text):
     allowed_tags = [
         "b",
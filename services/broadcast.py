@@ -0,0 +1,262 @@
+import asyncio
+import logging
+import time
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, Iterable
+
+from aiogram import Bot
+from aiogram.exceptions import (
+    TelegramBadRequest,
+    TelegramForbiddenError,
+    TelegramNetworkError,
+    TelegramRetryAfter,
+    TelegramServerError,
+)
+from sqlalchemy import select, update
+
+from core.database import orm_query as orm
+from core.database.engine import session_maker
+from core.database.models import Broadcast, User
+from core.metrics import BROADCAST_SENDS
+from services.lease import Lease
+
+logger = logging.getLogger(__name__)
+
+SENT = "sent"
+BLOCKED = "blocked"
+FAILED = "failed"
+
+_tasks = set()
+
+
+class RateLimiter:
+    """Spaces API calls so no more than ``rate`` go out per second."""
+
+    def __init__(self, rate: float):
+        self.interval = 1 / rate
+        self._next = 0.0
+        self._lock = asyncio.Lock()
+
+    async def acquire(self, tokens: int = 1) -> None:
+        async with self._lock:
+            now = time.monotonic()
+            wait = self._next - now
+            self._next = max(now, self._next) + self.interval * tokens
+
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    def pause(self, seconds: float) -> None:
+        # Flood control is per bot, so a retry_after holds back every worker
+        self._next = max(self._next, time.monotonic() + seconds)
+
+
+@dataclass
+class BroadcastResult:
+    statuses: dict[int, str] = field(default_factory=dict)
+    elapsed: float = 0.0
+
+    def count(self, status: str) -> int:
+        return sum(1 for value in self.statuses.values() if value == status)
+
+    @property
+    def rate(self) -> float:
+        return len(self.statuses) / self.elapsed if self.elapsed else 0.0
+
+
+class Broadcaster:
+    """Sends to many chats with a bounded pool of workers.
+
+    ``rate`` is the global number of API calls per second and ``cost`` is how
+    many calls a single ``send`` makes. Each chat is handled by one worker, so
+    calls to the same chat never overlap.
+
+    ``max_retries`` counts network and server errors only. Flood waits are
+    not failures of the chat, a send waits them out for up to
+    ``max_flood_wait`` seconds in total.
+    """
+
+    def __init__(
+        self,
+        concurrency: int = 20,
+        rate: float = 25.0,
+        cost: int = 1,
+        max_retries: int = 3,
+        max_flood_wait: float = 600.0,
+        name: str = "broadcast",
+    ):
+        # Label of the sends in metrics
+        self.name = name
+        self.concurrency = concurrency
+        self.limiter = RateLimiter(rate)
+        self.cost = cost
+        self.max_retries = max_retries
+        self.max_flood_wait = max_flood_wait
+
+    async def run(
+        self, chat_ids: Iterable[int], send: Callable[[int], Awaitable]
+    ) -> BroadcastResult:
+        result = BroadcastResult()
+        semaphore = asyncio.Semaphore(self.concurrency)
+        started = time.monotonic()
+
+        async def deliver(chat_id: int):
+            async with semaphore:
+                status = await self._deliver(chat_id, send)
+                result.statuses[chat_id] = status
+                BROADCAST_SENDS.labels(self.name, status).inc()
+
+        await asyncio.gather(*(deliver(chat_id) for chat_id in chat_ids))
+
+        result.elapsed = time.monotonic() - started
+        return result
+
+    async def _deliver(self, chat_id: int, send: Callable[[int], Awaitable]) -> str:
+        attempt = 0
+        flood_wait = 0.0
+
+        while True:
+            await self.limiter.acquire(self.cost)
+
+            try:
+                await send(chat_id)
+                return SENT
+            except TelegramRetryAfter as e:
+                flood_wait += e.retry_after
+                if flood_wait > self.max_flood_wait:
+                    logger.warning(
+                        f"Chat {chat_id}: flood waits over {self.max_flood_wait}s"
+                    )
+                    return FAILED
+
+                logger.warning(f"Flood control, pausing for {e.retry_after}s")
+                self.limiter.pause(e.retry_after)
+            except TelegramForbiddenError:
+                return BLOCKED
+            except TelegramBadRequest as e:
+                logger.warning(f"Chat {chat_id}: {e.message}")
+                return FAILED
+            except (TelegramNetworkError, TelegramServerError) as e:
+                logger.warning(f"Chat {chat_id}: {e}, attempt {attempt + 1}")
+                if attempt >= self.max_retries:
+                    return FAILED
+
+                await asyncio.sleep(2**attempt)
+                attempt += 1
+            except Exception:
+                logger.exception(f"Chat {chat_id}: unexpected error")
+                return FAILED
+
+
+async def run_text_broadcast(
+    bot: Bot,
+    broadcast_pk: int,
+    batch_size: int = 500,
+    broadcaster: Broadcaster | None = None,
+):
+    # Every worker resumes running broadcasts, the lease picks one sender
+    async with Lease(f"broadcast_{broadcast_pk}") as lease:
+        if not lease.acquired:
+            logger.debug(f"Broadcast {broadcast_pk} is sent by another worker")
+            return
+
+        await _send_text_broadcast(
+            bot, broadcast_pk, lease, batch_size, broadcaster or Broadcaster()
+        )
+
+
+async def _send_text_broadcast(
+    bot: Bot,
+    broadcast_pk: int,
+    lease: Lease,
+    batch_size: int,
+    broadcaster: Broadcaster,
+):
+    total = 0
+    elapsed = 0.0
+
+    async with session_maker() as session:
+        broadcast = await session.get(Broadcast, broadcast_pk)
+        if broadcast.status != "running":
+            return
+
+        text = broadcast.text
+        last_user_pk = broadcast.last_user_pk
+
+    async def send(chat_id: int):
+        await bot.send_message(chat_id, text)
+
+    async with session_maker() as read_session:
+        async for users in orm.orm_read_batches(
+            read_session, User, batch_size=batch_size, after_pk=last_user_pk
+        ):
+            if not lease.held:
+                # Another worker took over from the last checkpoint
+                return
+
+            batch_result = await broadcaster.run([user.tg_id for user in users], send)
+            total += len(batch_result.statuses)
+            elapsed += batch_result.elapsed
+
+            # Checkpoint after every batch so a restart resumes from here
+            async with session_maker() as session:
+                await session.execute(
+                    update(Broadcast)
+                    .where(Broadcast.pk == broadcast_pk)
+                    .values(
+                        last_user_pk=users[-1].pk,
+                        sent=Broadcast.sent + batch_result.count(SENT),
+                        blocked=Broadcast.blocked + batch_result.count(BLOCKED),
+                        failed=Broadcast.failed + batch_result.count(FAILED),
+                    )
+                )
+                await session.commit()
+
+            logger.info(
+                f"Broadcast {broadcast_pk}: {total} processed, "
+                f"{batch_result.rate:.1f} msg/s"
+            )
+
+    async with session_maker() as session:
+        await session.execute(
+            update(Broadcast).where(Broadcast.pk == broadcast_pk).values(status="done")
+        )
+        await session.commit()
+        broadcast = await session.get(Broadcast, broadcast_pk)
+
+    rate = total / elapsed if elapsed else 0.0
+    summary = (
+        f"Рассылка завершена\n\nОтправлено: {broadcast.sent}\n"
+        f"Заблокировали бота: {broadcast.blocked}\nОшибки: {broadcast.failed}\n"
+        f"Скорость: {rate:.1f} сообщ./сек"
+    )
+    logger.info(f"Broadcast {broadcast_pk} done: {summary!r}")
+
+    if broadcast.report_chat_id:
+        await bot.send_message(broadcast.report_chat_id, summary)
+
+
+async def _run_logged(bot: Bot, broadcast_pk: int):
+    try:
+        await run_text_broadcast(bot, broadcast_pk)
+    except Exception:
+        logger.exception(f"Broadcast {broadcast_pk} stopped, it resumes on restart")
+
+
+def start_broadcast(bot: Bot, broadcast_pk: int) -> asyncio.Task:
+    task = asyncio.create_task(_run_logged(bot, broadcast_pk))
+    _tasks.add(task)
+    task.add_done_callback(_tasks.discard)
+    return task
+
+
+async def resume_broadcasts(bot: Bot) -> None:
+    async with session_maker() as session:
+        result = await session.execute(
+            select(Broadcast.pk).where(Broadcast.status == "running")
+        )
+        pending = list(result.scalars())
+
+    for broadcast_pk in pending:
+        logger.info(f"Resuming broadcast {broadcast_pk}")
+        start_broadcast(bot, broadcast_pk)
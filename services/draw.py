@@ -0,0 +1,122 @@
+import asyncio
+import random
+import time
+from contextlib import asynccontextmanager
+from datetime import date, datetime, timedelta, timezone
+from zoneinfo import ZoneInfo
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from core.database.models import Card
+
+COOLDOWN = timedelta(days=10)
+KYIV_TZ = ZoneInfo("Europe/Kiev")
+
+
+class DeckCache:
+    """Card primary keys kept in memory so a draw never loads the whole deck.
+
+    Admin handlers invalidate it when cards are added or removed, the TTL
+    covers changes made by other processes.
+    """
+
+    def __init__(self, ttl: float = 60.0):
+        self.ttl = ttl
+        self._ids: list[int] = []
+        self._loaded_at = None
+
+    async def ids(self, session: AsyncSession) -> list[int]:
+        if self._loaded_at is None or time.monotonic() - self._loaded_at > self.ttl:
+            result = await session.execute(select(Card.pk))
+            self._ids = list(result.scalars())
+            self._loaded_at = time.monotonic()
+
+        return self._ids
+
+    def invalidate(self) -> None:
+        self._loaded_at = None
+
+
+deck = DeckCache()
+
+
+class KeyedLock:
+    """One asyncio.Lock per key, dropped once nobody holds or waits for it."""
+
+    def __init__(self):
+        self._locks: dict[int, asyncio.Lock] = {}
+        self._users: dict[int, int] = {}
+
+    @asynccontextmanager
+    async def __call__(self, key: int):
+        lock = self._locks.get(key)
+        if lock is None:
+            lock = self._locks[key] = asyncio.Lock()
+
+        self._users[key] = self._users.get(key, 0) + 1
+
+        try:
+            async with lock:
+                yield
+        finally:
+            self._users[key] -= 1
+            if not self._users[key]:
+                del self._users[key]
+                del self._locks[key]
+
+
+# Draws of one user run one at a time within a worker
+user_locks = KeyedLock()
+
+
+def to_utc_naive(dt: datetime) -> datetime:
+    # card_draw.drawn_at is stored as naive UTC
+    return dt.astimezone(timezone.utc).replace(tzinfo=None)
+
+
+def day_start(now: datetime) -> datetime:
+    local_midnight = now.astimezone(KYIV_TZ).replace(
+        hour=0, minute=0, second=0, microsecond=0
+    )
+    return to_utc_naive(local_midnight)
+
+
+def local_day(now: datetime) -> date:
+    # Daily limits reset at Kyiv midnight
+    return now.astimezone(KYIV_TZ).date()
+
+
+def cooldown_start(now: datetime) -> datetime:
+    # Cards drawn after this moment can't be drawn again
+    return to_utc_naive(now - COOLDOWN)
+
+
+def pick_card_id(deck_ids: list[int], excluded: set[int], attempts: int = 8):
+    if not deck_ids:
+        return None
+
+    # Most of the deck is usually free, so a few random probes are enough
+    for _ in range(attempts):
+        pk = random.choice(deck_ids)
+        if pk not in excluded:
+            return pk
+
+    free_ids = [pk for pk in deck_ids if pk not in excluded]
+    return random.choice(free_ids) if free_ids else None
+
+
+async def draw_card(session: AsyncSession, excluded: set[int]):
+    for _ in range(2):
+        pk = pick_card_id(await deck.ids(session), excluded)
+        if pk is None:
+            return None
+
+        card = await session.get(Card, pk)
+        if card is not None:
+            return card
+
+        # The card was deleted by another process, reload the deck once
+        deck.invalidate()
+
+    return None
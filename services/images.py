@@ -0,0 +1,297 @@
+import asyncio
+import hashlib
+import io
+import logging
+import os
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+
+from PIL import Image, ImageOps
+from sqlalchemy import delete, func, select, update
+
+from core.database.engine import session_maker
+from core.database.models import Card, ImageBlob
+
+logger = logging.getLogger(__name__)
+
+IMAGES_DIR = "images"
+# Unreferenced files are kept this long, covers uploads that aren't
+# committed yet and a card deleted and added back
+GC_GRACE = timedelta(hours=1)
+
+# Longest side and JPEG quality of stored card images
+IMAGE_MAX_SIDE = int(os.getenv("IMAGE_MAX_SIDE", "1280"))
+IMAGE_QUALITY = int(os.getenv("IMAGE_QUALITY", "85"))
+
+# Pillow releases the GIL while decoding and encoding, a couple of threads
+# keep uploads off the event loop without competing with it
+_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="images")
+
+
+@dataclass(frozen=True)
+class ProcessedImage:
+    data: bytes
+    width: int
+    height: int
+    content_hash: str
+
+    @property
+    def size_bytes(self) -> int:
+        return len(self.data)
+
+
+def process_image(raw: bytes) -> ProcessedImage:
+    """Re-encode an upload as a baseline JPEG without metadata."""
+    with Image.open(io.BytesIO(raw)) as image:
+        # Apply the EXIF rotation before the EXIF block is dropped
+        image = ImageOps.exif_transpose(image).convert("RGB")
+        image.thumbnail((IMAGE_MAX_SIDE, IMAGE_MAX_SIDE), Image.Resampling.LANCZOS)
+
+        buffer = io.BytesIO()
+        image.save(buffer, "JPEG", quality=IMAGE_QUALITY, optimize=True)
+
+    data = buffer.getvalue()
+    return ProcessedImage(
+        data=data,
+        width=image.width,
+        height=image.height,
+        content_hash=hashlib.sha256(data).hexdigest(),
+    )
+
+
+def store_path(content_hash: str, directory: str = IMAGES_DIR) -> str:
+    # images/ab/cd/abcd....jpg, two levels keep every directory small
+    return os.path.join(
+        directory, content_hash[:2], content_hash[2:4], f"{content_hash}.jpg"
+    )
+
+
+def _write(path: str, data: bytes) -> None:
+    # Same content, same name, an existing file is already right. Its mtime
+    # is refreshed, the GC keeps files touched within the grace period
+    # while their reference isn't committed yet
+    if os.path.exists(path):
+        try:
+            os.utime(path)
+            return
+        except FileNotFoundError:
+            pass
+
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    # Own temp file per call, the same image may be uploaded twice at once.
+    # Whichever replace lands last leaves the same bytes in place
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+
+    try:
+        with os.fdopen(fd, "wb") as f:
+            os.fchmod(f.fileno(), 0o644)
+            f.write(data)
+
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+async def ingest_image(raw: bytes, directory: str = IMAGES_DIR):
+    """Process an upload in the pool and store it, returns (path, image).
+
+    The caller records the reference with ``orm_add_image_ref`` in the
+    transaction that creates the card.
+    """
+    loop = asyncio.get_running_loop()
+    image = await loop.run_in_executor(_executor, process_image, raw)
+
+    path = store_path(image.content_hash, directory)
+    await loop.run_in_executor(_executor, _write, path, image.data)
+    return path, image
+
+
+def _utcnow() -> datetime:
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+def _remove_stale(path: str, cutoff: float) -> bool:
+    # Files written or re-uploaded after the cutoff are kept
+    try:
+        if os.path.getmtime(path) >= cutoff:
+            return False
+
+        os.remove(path)
+    except FileNotFoundError:
+        return False
+
+    return True
+
+
+def _remove_orphans(directory: str, known: set[str], cutoff: float) -> list[str]:
+    removed = []
+
+    for root, dirs, files in os.walk(directory, topdown=False):
+        # Shard directories emptied by earlier runs
+        if root != directory and not dirs and not files:
+            os.rmdir(root)
+            continue
+
+        for name in files:
+            path = os.path.join(root, name)
+
+            # .gitignore and friends, files still being written
+            if name.startswith(".") or os.path.normpath(path) in known:
+                continue
+
+            if _remove_stale(path, cutoff):
+                removed.append(path)
+
+    return removed
+
+
+async def collect_garbage(directory: str = IMAGES_DIR, grace: timedelta = GC_GRACE):
+    """Remove files no card uses any more, returns how many were removed."""
+    loop = asyncio.get_running_loop()
+    cutoff = time.time() - grace.total_seconds()
+    removed = 0
+
+    async with session_maker() as session:
+        result = await session.execute(
+            select(ImageBlob.pk, ImageBlob.path).where(
+                ImageBlob.refs <= 0, ImageBlob.released_at < _utcnow() - grace
+            )
+        )
+        dead = result.all()
+
+        if dead:
+            # refs is checked again, a card added meanwhile keeps its file
+            result = await session.execute(
+                delete(ImageBlob)
+                .where(ImageBlob.pk.in_([pk for pk, _ in dead]), ImageBlob.refs <= 0)
+                .returning(ImageBlob.path)
+            )
+            dead_paths = list(result.scalars())
+            await session.commit()
+
+            # A file re-uploaded meanwhile is kept, once its card is
+            # committed the blob row is back
+            for path in dead_paths:
+                removed += await loop.run_in_executor(
+                    _executor, _remove_stale, path, cutoff
+                )
+
+        # Files without a blob row or card, e.g. pre-store uploads
+        known = set(await session.scalars(select(ImageBlob.path)))
+        known.update(await session.scalars(select(Card.image)))
+
+    orphans = await loop.run_in_executor(
+        _executor,
+        _remove_orphans,
+        directory,
+        {os.path.normpath(path) for path in known},
+        cutoff,
+    )
+
+    removed += len(orphans)
+    if removed:
+        logger.info(f"Image GC removed {removed} files")
+
+    return removed
+
+
+def _missing_files(paths: list[str]) -> set[str]:
+    return {path for path in paths if not os.path.exists(path)}
+
+
+def _read_and_hash(path: str):
+    with open(path, "rb") as f:
+        data = f.read()
+
+    return data, hashlib.sha256(data).hexdigest()
+
+
+async def check_images(directory: str = IMAGES_DIR, repair: bool = True) -> dict:
+    """Compare the card table with the image store.
+
+    Cards stored before the store are moved into it, refs are recounted
+    from the cards and cards whose file is missing are reported (they need
+    a new upload). Returns the counts of each.
+    """
+    loop = asyncio.get_running_loop()
+    report = {"adopted": 0, "refs_fixed": 0, "missing": []}
+
+    async with session_maker() as session:
+        cards = (
+            await session.execute(select(Card.pk, Card.image, Card.content_hash))
+        ).all()
+        missing = await loop.run_in_executor(
+            _executor, _missing_files, [image for _, image, _ in cards]
+        )
+
+        for pk, image, content_hash in cards:
+            if image in missing:
+                report["missing"].append(pk)
+                continue
+
+            if content_hash and image == store_path(content_hash, directory):
+                continue
+
+            if not repair:
+                continue
+
+            data, content_hash = await loop.run_in_executor(
+                _executor, _read_and_hash, image
+            )
+            path = store_path(content_hash, directory)
+            await loop.run_in_executor(_executor, _write, path, data)
+            # The old file is left to the GC
+            await session.execute(
+                update(Card)
+                .where(Card.pk == pk)
+                .values(image=path, content_hash=content_hash, size_bytes=len(data))
+            )
+            report["adopted"] += 1
+
+        if repair and report["adopted"]:
+            await session.commit()
+
+        counts = dict(
+            (
+                await session.execute(
+                    select(Card.content_hash, func.count())
+                    .where(Card.content_hash.isnot(None))
+                    .group_by(Card.content_hash)
+                )
+            ).all()
+        )
+        blobs = {blob.pk: blob for blob in await session.scalars(select(ImageBlob))}
+
+        for content_hash in counts.keys() | blobs.keys():
+            refs = counts.get(content_hash, 0)
+            blob = blobs.get(content_hash)
+
+            if blob is not None and blob.refs == refs:
+                continue
+
+            report["refs_fixed"] += 1
+            if not repair:
+                continue
+
+            if blob is None:
+                blob = ImageBlob(
+                    pk=content_hash, path=store_path(content_hash, directory)
+                )
+                session.add(blob)
+
+            blob.refs = refs
+            if refs == 0:
+                blob.released_at = _utcnow()
+
+        if repair:
+            await session.commit()
+
+    if report["adopted"] or report["refs_fixed"] or report["missing"]:
+        logger.warning(f"Image store check: {report}")
+
+    return report
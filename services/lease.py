@@ -0,0 +1,118 @@
+import asyncio
+import logging
+import os
+import socket
+import uuid
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import delete, update
+from sqlalchemy.exc import IntegrityError
+
+from core.database.engine import session_maker
+from core.database.models import JobLease
+
+logger = logging.getLogger(__name__)
+
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+
+
+def _utcnow() -> datetime:
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+class Lease:
+    """Claim on a named job that every worker sees through the database.
+
+    Only one holder at a time gets ``acquired``. The holder renews the lease
+    in the background while the block runs, so a long job keeps it, and a
+    worker that dies just lets it expire after ``ttl`` seconds.
+
+        async with Lease("daily_cards") as lease:
+            if lease.acquired:
+                ...
+    """
+
+    def __init__(self, name: str, ttl: float = 60.0):
+        self.name = name
+        self.ttl = ttl
+        # Unique per claim, two jobs in one process don't share a lease
+        self.owner = f"{WORKER_ID}:{uuid.uuid4().hex[:8]}"
+        self.acquired = False
+        self.lost = False
+        self._renew_task = None
+
+    @property
+    def held(self) -> bool:
+        return self.acquired and not self.lost
+
+    async def acquire(self) -> bool:
+        now = _utcnow()
+        expires_at = now + timedelta(seconds=self.ttl)
+
+        async with session_maker() as session:
+            result = await session.execute(
+                update(JobLease)
+                .where(JobLease.pk == self.name, JobLease.expires_at < now)
+                .values(owner=self.owner, expires_at=expires_at)
+            )
+
+            if result.rowcount == 0:
+                # Either nobody took it yet or it is held by someone else
+                session.add(
+                    JobLease(pk=self.name, owner=self.owner, expires_at=expires_at)
+                )
+
+            try:
+                await session.commit()
+            except IntegrityError:
+                return False
+
+        self.acquired = True
+        self._renew_task = asyncio.create_task(self._renew())
+        return True
+
+    async def _renew(self) -> None:
+        while True:
+            await asyncio.sleep(self.ttl / 3)
+
+            try:
+                async with session_maker() as session:
+                    result = await session.execute(
+                        update(JobLease)
+                        .where(JobLease.pk == self.name, JobLease.owner == self.owner)
+                        .values(expires_at=_utcnow() + timedelta(seconds=self.ttl))
+                    )
+                    await session.commit()
+            except Exception:
+                # A missed renewal is fine as long as a later one succeeds
+                logger.exception(f"Failed to renew lease {self.name}")
+                continue
+
+            if result.rowcount == 0:
+                self.lost = True
+                logger.warning(f"Lease {self.name} was taken over by another worker")
+                return
+
+    async def release(self) -> None:
+        if self._renew_task is not None:
+            self._renew_task.cancel()
+
+        if not self.acquired:
+            return
+
+        async with session_maker() as session:
+            await session.execute(
+                delete(JobLease).where(
+                    JobLease.pk == self.name, JobLease.owner == self.owner
+                )
+            )
+            await session.commit()
+
+        self.acquired = False
+
+    async def __aenter__(self) -> "Lease":
+        await self.acquire()
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        await self.release()
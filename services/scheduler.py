@@ -1,74 +1,360 @@
-from sqlalchemy.ext.asyncio import AsyncSession
-import random
 import logging
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 from zoneinfo import ZoneInfo
 
-from aiogram.types import Message, FSInputFile
-from core.database.models import User, Card
+from aiogram import Bot
+from apscheduler.schedulers.asyncio import AsyncIOScheduler
+from apscheduler.triggers.cron import CronTrigger
+from sqlalchemy import select, update
+
+from core.config import BotConfig, ConfigStore
 from core.database import orm_query as orm
+from core.database.engine import session_maker
+from core.database.models import User, Card, CardDraw, JobRun
+from core.metrics import DRAWS
+from core.utils import send_card_photo
+from services.broadcast import Broadcaster, SENT, resume_broadcasts
+from services.draw import (
+    KYIV_TZ,
+    cooldown_start,
+    local_day,
+    pick_card_id,
+    to_utc_naive,
+)
+from services.images import check_images, collect_garbage
+from services.lease import Lease
 
 logger = logging.getLogger(__name__)
 
+DAILY_CARDS_JOB = "daily_cards"
+SYNC_JOB = "sync_worker"
+IMAGE_MAINTENANCE_JOB = "image_maintenance"
+# A run missed by at most this much (e.g. during a deploy) is still made
+MISFIRE_GRACE = timedelta(hours=2)
 
-async def get_random_card(message: Message, session: AsyncSession) -> None:
-    try:
-        users = await orm.orm_read(session=session, model=User, as_iterable=True)
-        logger.info(f"Fetched {len(users)} users for random card selection.")
+scheduler = AsyncIOScheduler(timezone=KYIV_TZ)
 
-        for user in users:
-            if not user.subscription:
-                continue
+# Jobs only reference importable functions without arguments, the bot they
+# send with and the config are registered here by setup_scheduler()
+_bot: Bot | None = None
+_config: ConfigStore | None = None
+# Schedule of the armed daily cards job, None when it is off
+_armed: tuple | None = None
+
+
+def _schedule(config: BotConfig) -> tuple:
+    return config.notification_time, tuple(config.notification_days)
+
+
+def daily_cards_trigger(config: BotConfig) -> CronTrigger:
+    return CronTrigger(
+        hour=config.notification_time,
+        day_of_week=",".join(config.notification_days),
+        timezone=KYIV_TZ,
+    )
+
+
+def arm_daily_cards(config: BotConfig) -> None:
+    global _armed
+    _armed = _schedule(config)
+    scheduler.add_job(
+        run_daily_cards,
+        daily_cards_trigger(config),
+        id=DAILY_CARDS_JOB,
+        replace_existing=True,
+        coalesce=True,
+        misfire_grace_time=int(MISFIRE_GRACE.total_seconds()),
+    )
+    logger.info(
+        f"Daily cards armed for {config.notification_time}:00, "
+        f"days: {config.notification_days}"
+    )
+
+
+def disarm_daily_cards() -> None:
+    global _armed
+    _armed = None
+
+    if scheduler.get_job(DAILY_CARDS_JOB):
+        scheduler.remove_job(DAILY_CARDS_JOB)
+        logger.info("Daily cards disarmed.")
+
+
+def latest_fire_time(config: BotConfig, now: datetime) -> datetime | None:
+    # Most recent fire time at or before now, a week back covers any schedule
+    trigger = daily_cards_trigger(config)
+    latest = None
+    fire_time = trigger.get_next_fire_time(None, now - timedelta(days=8))
+
+    while fire_time is not None and fire_time <= now:
+        latest = fire_time
+        fire_time = trigger.get_next_fire_time(
+            fire_time, fire_time + timedelta(seconds=1)
+        )
+
+    return latest
+
+
+def _is_due(config: BotConfig, job_run: JobRun | None) -> bool:
+    if not config.scheduler_status:
+        return False
+
+    if job_run is None or job_run.last_run_at is None:
+        return True
+
+    # Due when a fire time has passed since the last completed run
+    latest = latest_fire_time(config, datetime.now(KYIV_TZ))
+    return latest is not None and to_utc_naive(latest) > job_run.last_run_at
+
+
+async def run_daily_cards() -> None:
+    # Every worker fires the job, the lease and last_run_at make sure the
+    # cards go out once
+    async with Lease(DAILY_CARDS_JOB, ttl=120) as lease:
+        if not lease.acquired:
+            logger.info("Daily cards are sent by another worker.")
+            return
+
+        config = _config.current
+        now = datetime.now(KYIV_TZ)
+        fire_time = to_utc_naive(latest_fire_time(config, now) or now)
+
+        async with session_maker() as session:
+            job_run = await session.get(JobRun, DAILY_CARDS_JOB)
+
+            if not _is_due(config, job_run):
+                logger.info("Daily cards were already sent by another worker.")
+                return
+
+            if job_run is None:
+                job_run = JobRun(pk=DAILY_CARDS_JOB)
+                session.add(job_run)
+
+            # A run of the same fire time was interrupted, resume after the
+            # last finished batch
+            if job_run.fire_time != fire_time or job_run.last_user_pk is None:
+                job_run.fire_time = fire_time
+                job_run.last_user_pk = 0
+            elif job_run.last_user_pk:
+                logger.info(f"Daily cards resume after user {job_run.last_user_pk}.")
+
+            after_pk = job_run.last_user_pk
+            await session.commit()
+
+        try:
+            await send_daily_cards(_bot, after_pk=after_pk)
+        except Exception:
+            # last_run_at stays as it was, the run is still due
+            logger.exception("Error in send_daily_cards")
+            return
+
+        async with session_maker() as session:
+            job_run = await session.get(JobRun, DAILY_CARDS_JOB)
+            job_run.last_run_at = to_utc_naive(datetime.now(timezone.utc))
+            job_run.fire_time = None
+            job_run.last_user_pk = None
+            await session.commit()
+
+
+async def sync_worker() -> None:
+    # An admin change is applied by the worker that handled it, the others
+    # see it through the reloaded config.json and follow here
+    config = _config.current
+
+    if config.scheduler_status and _schedule(config) != _armed:
+        arm_daily_cards(config)
+    elif not config.scheduler_status and _armed is not None:
+        disarm_daily_cards()
+
+    # Picks up broadcasts left behind by a worker that went away
+    await resume_broadcasts(_bot)
+
+
+async def image_maintenance() -> None:
+    # Card table against the image store, then unreferenced files
+    async with Lease(IMAGE_MAINTENANCE_JOB, ttl=600) as lease:
+        if not lease.acquired:
+            return
+
+        await check_images()
+        await collect_garbage()
+
+
+async def setup_scheduler(bot: Bot, config_store: ConfigStore) -> None:
+    global _bot, _config
+    _bot = bot
+    _config = config_store
+    config = config_store.current
+    scheduler.start()
+    scheduler.add_job(
+        sync_worker, "interval", minutes=1, id=SYNC_JOB, replace_existing=True
+    )
+    scheduler.add_job(
+        image_maintenance,
+        "interval",
+        hours=6,
+        id=IMAGE_MAINTENANCE_JOB,
+        replace_existing=True,
+        next_run_time=datetime.now(KYIV_TZ) + timedelta(minutes=5),
+    )
 
-            # Get all cards from db
-            all_cards = await orm.orm_read(
+    if not config.scheduler_status:
+        return
+
+    arm_daily_cards(config)
+
+    async with session_maker() as session:
+        job_run = await session.get(JobRun, DAILY_CARDS_JOB)
+
+    if job_run is None or job_run.last_run_at is None:
+        return
+
+    # Catch up on a run that fell into the downtime or was interrupted by it
+    now = datetime.now(KYIV_TZ)
+    missed = latest_fire_time(config, now)
+
+    if (
+        missed is not None
+        and to_utc_naive(missed) > job_run.last_run_at
+        and now - missed <= MISFIRE_GRACE
+    ):
+        logger.info(f"Daily cards run of {missed.isoformat()} was missed, running now.")
+        scheduler.add_job(run_daily_cards, id=f"{DAILY_CARDS_JOB}_catch_up")
+
+
+def shutdown_scheduler() -> None:
+    if scheduler.running:
+        scheduler.shutdown(wait=False)
+
+
+async def send_daily_cards(bot: Bot, batch_size: int = 1000, after_pk: int = 0) -> None:
+    actual_time = datetime.now(ZoneInfo("Europe/Kiev"))
+    since = cooldown_start(actual_time)
+
+    # The deck is loaded once for the whole run
+    async with session_maker() as session:
+        cards = {
+            card.pk: card
+            for card in await orm.orm_read(
                 session=session, model=Card, as_iterable=True
             )
-            logger.info(
-                f"User {user.pk}: Retrieved {len(all_cards)} cards from database."
-            )
+        }
+
+    if not cards:
+        logger.warning("Daily cards: no cards in the deck.")
+        return
+
+    file_ids = {pk: card.file_id for pk, card in cards.items()}
+    # photo + description
+    broadcaster = Broadcaster(cost=2, name=DAILY_CARDS_JOB)
+    total = sent = 0
+
+    async with session_maker() as read_session:
+        async for users in orm.orm_read_batches(
+            read_session,
+            User,
+            batch_size=batch_size,
+            after_pk=after_pk,
+            subscription=True,
+        ):
+            picks = await _draw_batch(users, cards, since, actual_time)
 
-            actual_time = datetime.now(ZoneInfo("Europe/Kiev"))
-            # Convert to offset-naive datetime
-            actual_time_naive = actual_time.replace(tzinfo=None)
-            free_cards = []
-            exiting_cards = user.cards or {}
-
-            # Get free cards
-            for card in all_cards:
-                if not str(card.pk) in exiting_cards.keys():
-                    free_cards.append(card)
-                else:
-                    exiting_time = datetime.fromisoformat(exiting_cards[str(card.pk)])
-                    if (actual_time - exiting_time) > timedelta(days=10):
-                        free_cards.append(card)
-
-            if free_cards:
-                random.shuffle(free_cards)
-                random_card = random.choice(free_cards)
-                exiting_cards[random_card.pk] = actual_time.isoformat()
-                await orm.orm_update(
-                    session=session,
-                    model=User,
-                    pk=user.pk,
-                    data={"cards": exiting_cards, "last_request": actual_time_naive},
+            async def send(chat_id: int):
+                card = picks[chat_id]
+
+                if card is None:
+                    await bot.send_message(
+                        chat_id,
+                        "Карты закончились 😞. Ежедневная карта будет доступна через 24 часа 🕛",
+                    )
+                    return
+
+                await send_card_photo(bot, chat_id, card, None)
+                await bot.send_message(
+                    chat_id, f"Ежедневная карта 🃏\n\n{card.description}"
                 )
-                logger.info(f"User {user.pk}: Assigned card {random_card.pk}.")
-                logger.info(
-                    f"User {user.pk}: Updated last_request to {actual_time.isoformat()}."
+
+            batch_result = await broadcaster.run(picks, send)
+            total += len(users)
+            sent += batch_result.count(SENT)
+
+            # Checkpoint after every batch so a restart resumes from here
+            async with session_maker() as session:
+                await session.execute(
+                    update(JobRun)
+                    .where(JobRun.pk == DAILY_CARDS_JOB)
+                    .values(last_user_pk=users[-1].pk)
                 )
+                await session.commit()
 
-                photo = FSInputFile(random_card.image, filename="card.jpg")
+            await _save_file_ids(cards, file_ids)
 
-                await message.answer_photo(photo=photo)
-                await message.answer(
-                    text=f"Ежедневная карта 🃏\n\n{random_card.description}",
+            logger.info(
+                f"Daily cards: {total} subscribers processed, "
+                f"{batch_result.rate:.1f} users/s"
+            )
+
+    logger.info(f"Daily cards done: {sent} of {total} subscribers reached.")
+
+
+async def _draw_batch(
+    users: list[User], cards: dict[int, Card], since: datetime, actual_time: datetime
+) -> dict[int, Card | None]:
+    deck_ids = list(cards)
+    drawn_at = to_utc_naive(actual_time)
+    # Convert to offset-naive datetime
+    actual_time_naive = actual_time.replace(tzinfo=None)
+
+    async with session_maker() as session:
+        result = await session.execute(
+            select(CardDraw.user_id, CardDraw.card_id).where(
+                CardDraw.user_id.in_([user.pk for user in users]),
+                CardDraw.drawn_at >= since,
+            )
+        )
+        recent = {}
+        for user_pk, card_pk in result.all():
+            recent.setdefault(user_pk, set()).add(card_pk)
+
+        picks = {}
+        draws = []
+        for user in users:
+            card_pk = pick_card_id(deck_ids, recent.get(user.pk, set()))
+            picks[user.tg_id] = cards.get(card_pk)
+
+            if card_pk is not None:
+                draws.append(
+                    {"user_id": user.pk, "card_id": card_pk, "drawn_at": drawn_at}
                 )
-                return
-            logger.warning(f"User {user.pk}: No free cards available.")
-            await message.answer(
-                "Карты закончились 😞. Ежедневная карта будет доступна через 24 часа 🕛"
+
+        if draws:
+            await session.execute(
+                update(User)
+                .where(User.pk.in_([draw["user_id"] for draw in draws]))
+                .values(last_request=actual_time_naive)
+            )
+            # Daily cards count towards cards_limit like any other draw
+            await orm.orm_add_daily_draws(
+                session, [draw["user_id"] for draw in draws], local_day(actual_time)
             )
-    except Exception as e:
-        logger.error(f"Error in get_random_card: {str(e)}")
-        await message.answer("Произошла ошибка при получении карты 😞.")
+            await orm.orm_bulk_insert(session, CardDraw, draws)
+            DRAWS.labels("daily").inc(len(draws))
+
+    return picks
+
+
+async def _save_file_ids(cards: dict[int, Card], file_ids: dict[int, str]) -> None:
+    # Cards uploaded for the first time during the run
+    changed = [
+        {"pk": pk, "file_id": card.file_id}
+        for pk, card in cards.items()
+        if card.file_id and card.file_id != file_ids[pk]
+    ]
+
+    if not changed:
+        return
+
+    async with session_maker() as session:
+        await orm.orm_bulk_update(session, Card, changed)
+
+    file_ids.update({row["pk"]: row["file_id"] for row in changed})
@@ -0,0 +1,81 @@
+import asyncio
+
+from aiogram.fsm.state import State, StatesGroup
+from aiogram.fsm.storage.base import StorageKey
+from sqlalchemy import func, select
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+
+from core.database.models import Base, FsmState
+from core.storage import SQLStorage
+
+
+class Form(StatesGroup):
+    name = State()
+
+
+KEY = StorageKey(bot_id=1, chat_id=10, user_id=10)
+
+
+def run(check):
+    async def main():
+        engine = create_async_engine("sqlite+aiosqlite://")
+        async with engine.begin() as conn:
+            await conn.run_sync(Base.metadata.create_all)
+
+        session_pool = async_sessionmaker(engine, expire_on_commit=False)
+        try:
+            await check(SQLStorage(session_pool), session_pool)
+        finally:
+            await engine.dispose()
+
+    asyncio.run(main())
+
+
+async def count_rows(session_pool) -> int:
+    async with session_pool() as session:
+        return await session.scalar(select(func.count()).select_from(FsmState))
+
+
+def test_clear_empty_key():
+    async def check(storage, session_pool):
+        await storage.set_state(KEY, None)
+        await storage.set_data(KEY, {})
+
+        assert await storage.get_state(KEY) is None
+        assert await storage.get_data(KEY) == {}
+        assert await count_rows(session_pool) == 0
+
+    run(check)
+
+
+def test_state_and_data_round_trip():
+    async def check(storage, session_pool):
+        await storage.set_state(KEY, Form.name)
+        await storage.set_data(KEY, {"card_pk": 5})
+
+        assert await storage.get_state(KEY) == Form.name.state
+        assert await storage.get_data(KEY) == {"card_pk": 5}
+
+        other = StorageKey(bot_id=1, chat_id=11, user_id=11)
+        assert await storage.get_state(other) is None
+
+        # FSMContext.clear()
+        await storage.set_state(KEY, None)
+        await storage.set_data(KEY, {})
+
+        assert await storage.get_state(KEY) is None
+        assert await storage.get_data(KEY) == {}
+        assert await count_rows(session_pool) == 0
+
+    run(check)
+
+
+def test_data_kept_without_state():
+    async def check(storage, session_pool):
+        await storage.set_data(KEY, {"step": 1})
+        await storage.set_state(KEY, None)
+
+        assert await storage.get_data(KEY) == {"step": 1}
+        assert await count_rows(session_pool) == 1
+
+    run(check)